@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from contextvars import ContextVar
+from telegram.request import HTTPXRequest
+import metrics
+import time
+
+
+# The user whose update is being processed; set by PerUserUpdateProcessor while it runs
+current_user = ContextVar("current_user", default=None)
+
+
+class CallCounter:
+    def __init__(self, max_users=10000):
+        """
+        Bot API requests made while handling each user's updates. The least recently active
+        users are forgotten beyond max_users.
+        """
+        self.max_users = max_users
+        self._counts = OrderedDict()
+
+    def increment(self, user_id):
+        self._counts[user_id] = self._counts.get(user_id, 0) + 1
+        self._counts.move_to_end(user_id)
+        if len(self._counts) > self.max_users:
+            self._counts.popitem(last=False)
+
+    def get(self, user_id):
+        return self._counts.get(user_id, 0)
+
+
+counter = CallCounter()
+
+
+class CountingRequest(HTTPXRequest):
+    """
+    HTTPXRequest that counts every Bot API round trip against the user being served, and times
+    it when metrics are enabled.
+    """
+
+    async def do_request(self, url, *args, **kwargs):
+        user_id = current_user.get()
+        if user_id is not None:
+            counter.increment(user_id)
+        if not metrics.ENABLED:
+            return await super().do_request(url, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            metrics.observe_api_call(url.rsplit("/", 1)[-1], time.perf_counter() - started)
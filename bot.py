@@ -1,21 +1,68 @@
 import configparser
-from pyexpat.errors import messages
 
-from asn1crypto.core import Boolean
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ForceReply
+from telegram import (
+    Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ForceReply,
+    InlineQueryResultArticle, InputTextMessageContent
+)
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler, filters
+    ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler, InlineQueryHandler, TypeHandler,
+    filters
 )
-from services_db import DatabaseManager
+from services_db import AsyncDatabaseManager
+from session_store import SessionStore, create_session_backend
+from update_processor import PerUserUpdateProcessor, serialize_handlers
+from callbacks import CallbackRouter, encode, pack_id, unpack_id
+from card_import import CardFileReader
+from card_export import export_to_file
+from inline_index import InlineIndexCache, PrefixIndex
+from reminders import ReviewReminders
+from api_calls import CountingRequest
+from outbox import OutboxRateLimiter
+import api_calls
+import metrics
+from scheduler import create_scheduler, grade_session, GOOD, AGAIN
+from datetime import datetime
+import callbacks
+import sharding
+import asyncio
+import csv
+import tempfile
 import random
+import time
 import os
 
 
-user_learning_sessions = {}  # user_id -> {"cards": [], "current_step": 0, "current_card_index": 0}
-user_general_session = {}
+ITEMS_PER_PAGE_CE = 5
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024  # Bot API download limit
+IMPORT_BATCH_SIZE = 1000
+IMPORT_PROGRESS_INTERVAL = 2  # seconds between progress edits
+INLINE_RESULTS = 50  # Bot API limit per answer
+# Seconds Telegram may reuse an answer for the same user and query
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))
+# Seconds an inline query waits for the user to stop typing before it is answered
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.3"))
+# Learning and traversal edit one message in place instead of sending one per question
+SINGLE_MESSAGE_SESSIONS = os.getenv("SINGLE_MESSAGE_SESSIONS", "1") == "1"
 config = configparser.ConfigParser()
 config.read("token.properties")
-db = DatabaseManager()
+# Set up by configure()
+db = None
+session_backend = None
+user_learning_sessions = None  # user_id -> {"deck_name": "", "cards": [], "current_step": 0, "current_card_index": 0}
+user_general_session = None
+inline_cards = None  # user_id -> PrefixIndex of the user's cards for inline queries
+latest_inline_query = {}  # user_id -> id of the user's newest inline query
+scheduler = create_scheduler()
+outbox = OutboxRateLimiter()
+
+# What the user's next plain text message answers, kept in user_general_session[user_id]["awaiting"]
+AWAIT_DECK_NAME = "deck_name"
+AWAIT_DELETE_DECK_NAME = "delete_deck_name"
+AWAIT_FRONT = "front"
+AWAIT_BACK = "back"
+AWAIT_ANSWER = "answer"
+
+router = CallbackRouter()
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -30,16 +77,16 @@ async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if (update.message.from_user.id not in user_general_session):
         user_general_session[update.message.from_user.id] = {}
     keyboard = [
-        [InlineKeyboardButton("📁List Decks", callback_data=f"command_switch_deck"), InlineKeyboardButton("➕Add a Deck", callback_data=f"command_add_deck")]
+        [InlineKeyboardButton("📁List Decks", callback_data=encode(callbacks.MENU_SWITCH_DECK)), InlineKeyboardButton("➕Add a Deck", callback_data=encode(callbacks.MENU_ADD_DECK))]
     ]
     await update.message.reply_text(text="Menu", reply_markup=InlineKeyboardMarkup(keyboard))
 
 
 async def get_keyboard():
     return [
-        [InlineKeyboardButton("📁Decks Menu", callback_data=f"command_switch_deck"), InlineKeyboardButton("🙋Learn", callback_data=f"command_learn_deck")],
-        [InlineKeyboardButton("🏃Traverse F to B", callback_data=f"traverse_top_to_bot"), InlineKeyboardButton("💃Traverse B to F", callback_data=f"traverse_bot_to_top")],
-        [InlineKeyboardButton("➕Add Cards", callback_data=f"command_add_cards_to_deck"), InlineKeyboardButton("➖Delete Cards", callback_data=f"command_delete_cards_in_deck")],
+        [InlineKeyboardButton("📁Decks Menu", callback_data=encode(callbacks.MENU_SWITCH_DECK)), InlineKeyboardButton("🙋Learn", callback_data=encode(callbacks.LEARN))],
+        [InlineKeyboardButton("🏃Traverse F to B", callback_data=encode(callbacks.TRAVERSE_FRONT)), InlineKeyboardButton("💃Traverse B to F", callback_data=encode(callbacks.TRAVERSE_BACK))],
+        [InlineKeyboardButton("➕Add Cards", callback_data=encode(callbacks.ADD_CARDS)), InlineKeyboardButton("➖Delete Cards", callback_data=encode(callbacks.DELETE_CARDS))],
     ]
 
 
@@ -48,7 +95,7 @@ async def cancel_adding(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if (user_id not in user_general_session):
         user_general_session[user_id] = {}
 
-    if user_general_session[user_id]["deck_name"]:
+    if user_general_session[user_id].get("deck_name"):
         keyboard = await get_keyboard()
         await update.message.reply_text(
             text="Current Deck: " + user_general_session[user_id]["deck_name"],
@@ -57,17 +104,31 @@ async def cancel_adding(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     else:
         keyboard = [
-            [InlineKeyboardButton("📁List Decks", callback_data=f"command_switch_deck"), InlineKeyboardButton("➕Add a Deck", callback_data=f"command_add_deck")]
+            [InlineKeyboardButton("📁List Decks", callback_data=encode(callbacks.MENU_SWITCH_DECK)), InlineKeyboardButton("➕Add a Deck", callback_data=encode(callbacks.MENU_ADD_DECK))]
         ]
         await update.message.reply_text(text="Menu", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
 
+async def __send_together(context, *sends):
+    """
+    Start several sends to one chat at once instead of awaiting each in turn, so the outbox finds
+    them queued together and merges consecutive texts into one message; its per-chat queue keeps
+    them in order. Without the outbox they are awaited one after the other.
+    """
+    if not isinstance(context.bot.rate_limiter, OutboxRateLimiter):
+        for send in sends:
+            await send
+        return
+    await asyncio.gather(*sends)
+
+
 async def list_decks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     #db = DatabaseManager()
     user_id = update.message.from_user.id
-    deck_ids = [deck.id for deck in sorted(db.get_all_decks(user_id), key=lambda deck: deck.name)]
-    deck_names = [deck.name for deck in sorted(db.get_all_decks(user_id), key=lambda deck: deck.name)]
+    decks = await db.get_all_decks(user_id)
+    deck_ids = [deck.id for deck in decks]
+    deck_names = [deck.name for deck in decks]
     if (update.message.from_user.id not in user_general_session):
         user_general_session[update.message.from_user.id] = {}
 
@@ -77,8 +138,7 @@ async def list_decks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = await __list_decks(deck_ids, deck_names, page)
         await update.message.reply_text(text="Pick a Deck", reply_markup=InlineKeyboardMarkup(keyboard))
     else:
-        await update.message.reply_text("No decks available.")
-        await show_menu(update, context)
+        await __send_together(context, update.message.reply_text("No decks available."), show_menu(update, context))
 
 
 async def traverse_cards(update: Update, user_id, is_reversed, context: ContextTypes.DEFAULT_TYPE):
@@ -89,41 +149,39 @@ async def traverse_cards(update: Update, user_id, is_reversed, context: ContextT
         return
 
     session["traversing_is_reverse"] = is_reversed
-    cards = session["traversing_cards"]
-    current_traverse_index = session["traverse_current_card_index"]
-
-    if current_traverse_index >= len(cards):
-        session["traverse_current_card_index"] = None
+    # Only the keyset position and the card on screen are kept, never the whole deck
+    card_page = None
+    if session.get("traverse_has_next"):
+        card_page = await db.select_cards_page(session["deck_name"], user_id, session["traverse_after"], 1, False)
+
+    if not card_page or not card_page.cards:
+        session["traverse_after"] = None
+        session["traverse_has_next"] = None
         session["traversing_is_reverse"] = None
-        session["traversing_cards"] = {}
+        session["traversing_card"] = None
         keyboard = await get_keyboard()
         result_message = "Current Deck: " + user_general_session[user_id]["deck_name"]
-        await update.message.reply_text(
-            text=result_message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        result_message += f"\nBot API calls this session: {api_calls.counter.get(user_id) - session.pop('api_calls', 0) + 1}"
+        await __session_message(update, context, session, result_message, InlineKeyboardMarkup(keyboard))
+        session.pop("message_id", None)
         return
 
-    card = cards[current_traverse_index]
+    card = card_page.cards[0]
+    session["traversing_card"] = card
+    session["traverse_after"] = card_page.next_after
+    session["traverse_has_next"] = card_page.has_next
+    # Numbers the card on screen so a second tap on the same Reveal button cannot skip a card
+    session["traverse_position"] = session.get("traverse_position", 0) + 1
 
     keyboard = [
-        [InlineKeyboardButton("👁️Reveal other side", callback_data=f"show_and_traverse")]
+        [InlineKeyboardButton("👁️Reveal other side", callback_data=encode(callbacks.REVEAL, session["traverse_position"]))]
     ]
 
     if not is_reversed:
         message = f"What is the other side for: '{card.front}'?"
-        await update.message.reply_text(
-            text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
     else:
         message = f"What is the other side for: '{card.back}'?"
-        await update.message.reply_text(
-            text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-
-    session["traverse_current_card_index"] += 1
+    await __session_message(update, context, session, message, InlineKeyboardMarkup(keyboard))
 
 
 async def present_next_card(update: Update, user_id, context: ContextTypes.DEFAULT_TYPE):
@@ -149,63 +207,79 @@ async def present_next_card(update: Update, user_id, context: ContextTypes.DEFAU
     # Get the current card
     card = cards[session["current_card_index"]]
     current_step = session["current_step"]
+    session["question_card_id"] = card.id
 
     if current_step == 1:
         # Step 1: Multiple-choice for backs
         options = await generate_options(card, cards, "back")
         message = f"Step 1: What is the back for: '{card.front}'?"
-        await send_options(update, context, message, options, card.back, card.id)
+        await send_options(update, context, message, options, card.back, session)
 
     elif current_step == 2:
         # Step 2: Matching cards (front and back)
         message = f"Step 2: Match the front '{card.front}' with the correct back."
         back_options = [c.back for c in cards]
-        await send_options(update, context, message, back_options, card.back, card.id)
+        await send_options(update, context, message, back_options, card.back, session)
 
     elif current_step == 3:
         # Step 3: Multiple-choice for fronts
         options = await generate_options(card, cards, "front")
         message = f"Step 3: What is the front for: '{card.back}'?"
-        await send_options(update, context, message, options, card.front, card.id)
+        await send_options(update, context, message, options, card.front, session)
 
     elif current_step == 4:
         # Step 4: Typing the back
         message = f"Step 4: Type the back for: '{card.front}'"
-        session["correctCard"] = card
-        await update.message.reply_text(
-            text=message,
-            reply_markup=ForceReply()
-        )
+        user_general_session.setdefault(user_id, {})["awaiting"] = AWAIT_ANSWER
+        await __session_message(update, context, session, message, ForceReply())
 
     elif current_step == 5:
         # Step 5: Typing the front
         message = f"Step 5: Type the front for: '{card.back}'"
-        session["correctCard"] = card
-        await update.message.reply_text(
-            text=message,
-            reply_markup=ForceReply()
-        )
+        user_general_session.setdefault(user_id, {})["awaiting"] = AWAIT_ANSWER
+        await __session_message(update, context, session, message, ForceReply())
 
     # Move to the next card in the session
     session["current_card_index"] += 1
 
 
-async def send_options(update, context, question, options, correct_option, correct_card_id):
+async def send_options(update, context, question, options, correct_option, session):
+    # Buttons carry the question number and the option index; the answer stays in the session
+    session["question"] = session.get("question", 0) + 1
+    session["correct_option"] = options.index(correct_option)
     keyboard = [
-        [InlineKeyboardButton(option, callback_data=("correct_" + correct_card_id if option == correct_option else "incorrect_" + correct_card_id))]
-        for option in options
+        [InlineKeyboardButton(option, callback_data=encode(callbacks.ANSWER, session["question"], index))]
+        for index, option in enumerate(options)
     ]
 
-    if update.message:  # If called from a standard message
-        await update.message.reply_text(
-            text=question,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    elif update.callback_query:  # If called from a callback query
-        await update.callback_query.message.reply_text(
-            text=question,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+    if not update.message and update.callback_query:  # If called with an Update for a callback query
+        update = update.callback_query
+    await __session_message(update, context, session, question, InlineKeyboardMarkup(keyboard))
+
+
+async def __session_message(update, context, session, text, reply_markup=None):
+    """
+    Show the next screen of a learning or traversal session. Feedback left in session["feedback"]
+    is put above the text. In single-message mode the session's message is edited in place; a new
+    message is sent in classic mode, and for ForceReply prompts, which an edit cannot attach.
+    :param update: An Update or CallbackQuery whose message is replied to when a message is sent.
+    """
+    feedback = session.pop("feedback", None)
+    if feedback:
+        text = feedback + "\n\n" + text
+    if SINGLE_MESSAGE_SESSIONS and session.get("message_id") and not isinstance(reply_markup, ForceReply):
+        await context.bot.edit_message_text(
+            chat_id=session["chat_id"],
+            message_id=session["message_id"],
+            text=text,
+            reply_markup=reply_markup
         )
+        return
+    message = await update.message.reply_text(text=text, reply_markup=reply_markup)
+    if SINGLE_MESSAGE_SESSIONS:
+        # A ForceReply message cannot later be given an inline keyboard, so the next screen is sent anew
+        session["message_id"] = None if isinstance(reply_markup, ForceReply) else message.message_id
+        session["chat_id"] = message.chat_id
 
 
 async def show_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -215,29 +289,39 @@ async def show_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     #db = DatabaseManager()
 
     results = []
+    now = datetime.now()
     for card in cards:
         progress = session["progress"][card.id]
         correct = progress["correct"]
         incorrect = progress["incorrect"]
 
-        # Update card level based on answers
-        if correct >= 3 and card.level < 6:
+        grade = grade_session(correct, incorrect)
+        scheduler.review(card, grade, now)
+        if grade >= GOOD and card.level < 6:
             card.level += 1
-        if incorrect >= 4 and card.level > 0:
+        if grade == AGAIN and card.level > 0:
             card.level -= 1
 
-        results.append(f"Card '{card.front}' - Correct: {correct}, Incorrect: {incorrect}, Level: {card.level}")
-        db.edit_card(user_general_session[update.message.from_user.id]["deck_name"], card.front, card.back, card.level, user_id)
+        results.append(f"Card '{card.front}' - Correct: {correct}, Incorrect: {incorrect}, Level: {card.level}, "
+                       f"Next review: {__format_due(card.due_at - now)}")
+    await db.commit_progress(session["deck_name"], cards, user_id)
     # Display results
     keyboard = await get_keyboard()
-    result_message = "Learning Session Complete! Results:\n" + "\n".join(results) + "\nCurrent Deck: " + user_general_session[user_id]["deck_name"]
-    await update.message.reply_text(
-        text=result_message,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    result_message = "Learning Session Complete! Results:\n" + "\n".join(results) + "\nCurrent Deck: " + session["deck_name"]
+    result_message += f"\nBot API calls this session: {api_calls.counter.get(user_id) - session.get('api_calls', 0) + 1}"
+    await __session_message(update, context, session, result_message, InlineKeyboardMarkup(keyboard))
     user_learning_sessions.pop(user_id, None)  # Clear the session
 
 
+def __format_due(delta):
+    minutes = max(1, round(delta.total_seconds() / 60))
+    if minutes < 60:
+        return f"in {minutes} min"
+    if minutes < 24 * 60:
+        return f"in {round(minutes / 60)} h"
+    return f"in {round(minutes / (24 * 60))} d"
+
+
 async def handle_user_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     session = user_learning_sessions.get(user_id)
@@ -268,249 +352,578 @@ async def handle_user_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await present_next_card(update, user_id, context)
 
 
-async def handle_name_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Check if this is a reply to the ForceReply prompt
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Bulk-add cards from an uploaded CSV/TSV/Anki text file into the current deck
     user_id = update.message.from_user.id
-    #db = DatabaseManager()
-    session = user_learning_sessions.get(user_id)
-    correctCard = None
-
-    if session is not None:
-        if "correctCard" in session:
-            correctCard = session["correctCard"]
-    if update.message.reply_to_message and "Enter Deck Name" == update.message.reply_to_message.text:
-        deck_name = update.message.text  # The user's input
-        if db.add_deck(deck_name, user_id):
-            keyboard = await get_keyboard()
-            await update.message.reply_text(f"Deck '{deck_name}' created. Current deck: '{deck_name}'", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            await update.message.reply_text(f"Deck '{deck_name}' already exists.")
-        return
-    if update.message.reply_to_message and "Enter Deck Name that you want to DELETE" == update.message.reply_to_message.text:
-        deck_name = update.message.text
-        if db.get_deck(deck_name, user_id):
-            db.delete_deck(deck_name, user_id)
-            await update.message.reply_text(f"Deck '{deck_name}' deleted.")
-            await list_decks(update, context)
-        else:
-            await update.message.reply_text(f"Deck '{deck_name}' not found.")
-        return
-    if "deck_name" in user_general_session[user_id]:
-        if update.message.reply_to_message and "Type in FRONT (Deck: " + user_general_session[user_id]["deck_name"] + ")\n/cancel to stop adding (or any command)" == update.message.reply_to_message.text:
-            user_general_session[user_id]["front"] = update.message.text
-            await update.message.reply_text(
-                text="Type in BACK (Deck: " + user_general_session[user_id]["deck_name"] + ")\n/cancel to stop adding (or any command)",
-                reply_markup=ForceReply()
-            )
-            return
-        if update.message.reply_to_message and "Type in BACK (Deck: " + user_general_session[user_id]["deck_name"] + ")\n/cancel to stop adding (or any command)" == update.message.reply_to_message.text:
-            front = user_general_session[user_id]["front"]
-            back = update.message.text
-            db.add_card(user_general_session[user_id]["deck_name"], front, back, user_id)
-            await update.message.reply_text("Card has been added to Deck " + user_general_session[user_id]["deck_name"] + " and saved.")
-            await update.message.reply_text(
-                text="Type in FRONT (Deck: " + user_general_session[user_id]["deck_name"] + ")\n/cancel to stop adding (or any command)",
-                reply_markup=ForceReply()
-            )
-            return
-    if correctCard:
-        if update.message.reply_to_message and f"Step 4: Type the back for: '{correctCard.front}'" == update.message.reply_to_message.text:
-            back = update.message.text
-            if correctCard.back == back:
-                user_learning_sessions[user_id]["progress"][correctCard.id]["correct"] += 1
-                await update.message.reply_text("Correct! ✅")
-            else:
-                user_learning_sessions[user_id]["progress"][correctCard.id]["incorrect"] += 1
-                await update.message.reply_text("Incorrect. ❌")
-            await present_next_card(update, user_id, context)
-            return
-        if update.message.reply_to_message and f"Step 5: Type the front for: '{correctCard.back}'" == update.message.reply_to_message.text:
-            front = update.message.text
-            if correctCard.front == front:
-                user_learning_sessions[user_id]["progress"][correctCard.id]["correct"] += 1
-                await update.message.reply_text("Correct! ✅")
-            else:
-                user_learning_sessions[user_id]["progress"][correctCard.id]["incorrect"] += 1
-                await update.message.reply_text("Incorrect. ❌")
-            await present_next_card(update, user_id, context)
+    session = user_general_session.get(user_id)
+    deck_name = session.get("deck_name") if session else None
+    document = update.message.document
+    if not deck_name:
+        await update.message.reply_text("Pick a deck first, then send the file again.")
+        return
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        await update.message.reply_text("The file is too large, the limit is 20 MB.")
+        return
+
+    progress_message = await update.message.reply_text(f"Importing '{document.file_name}' into Deck {deck_name}...")
+    loop = asyncio.get_running_loop()
+    last_report = [time.monotonic()]
+
+    def report(processed, added):
+        # Runs on a database thread, the edit itself is scheduled on the event loop
+        now = time.monotonic()
+        if now - last_report[0] >= IMPORT_PROGRESS_INTERVAL:
+            last_report[0] = now
+            asyncio.run_coroutine_threadsafe(progress_message.edit_text(
+                f"Importing '{document.file_name}' into Deck {deck_name}: {processed} rows read, {added} cards added..."
+            ), loop)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "upload")
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+        reader = CardFileReader(path, document.file_name)
+        try:
+            result = await db.import_cards(deck_name, reader, user_id, IMPORT_BATCH_SIZE, report)
+        except (UnicodeDecodeError, csv.Error):
+            # Every backend imports a file all or nothing
+            await progress_message.edit_text(f"Could not read '{document.file_name}', no cards were imported. Send a UTF-8 CSV or TSV file with FRONT and BACK columns.")
             return
+    inline_cards.invalidate(user_id)
 
-    await show_menu(update, context)
+    if result is None:
+        await progress_message.edit_text(f"Deck '{deck_name}' not found.")
+        return
+    added, duplicates = result
+    keyboard = await get_keyboard()
+    await progress_message.edit_text(
+        f"Imported {added} cards into Deck {deck_name}. Skipped {duplicates} duplicates and {reader.invalid} invalid rows.",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
 
-async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    #db = DatabaseManager()
+async def set_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if not context.args or context.args[0].lower() not in ("on", "off"):
+        await update.message.reply_text("Usage: /reminders on|off")
+        return
+    enabled = context.args[0].lower() == "on"
+    await db.set_reminders(user_id, enabled)
+    await update.message.reply_text("Daily review reminders are " + ("on." if enabled else "off."))
 
-    if query.data == "command_add_deck":
-        await query.message.reply_text(
-            text="Enter Deck Name",
-            reply_markup=ForceReply()
-        )
+
+async def search_cards(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /search <text> - cards of every deck whose front or back matches, best match first
+    user_id = update.message.from_user.id
+    query = " ".join(context.args or []).strip()
+    if not query:
+        await update.message.reply_text("Usage: /search <text>")
         return
-    if query.data == "command_delete_deck":
-        await query.message.reply_text(
-            text="Enter Deck Name that you want to DELETE",
-            reply_markup=ForceReply()
+    if user_id not in user_general_session:
+        user_general_session[user_id] = {}
+    user_general_session[user_id]["search_query"] = query
+    text, reply_markup = await __search_page(user_id, query, 0)
+    await update.message.reply_text(text=text, reply_markup=reply_markup)
+
+
+async def __search_page(user_id, query, offset):
+    page = await db.search_cards(user_id, query, offset, ITEMS_PER_PAGE_CE)
+    if not page.hits:
+        return f"No cards match '{query}'.", None
+    lines = [f"Cards matching '{query}':"]
+    lines += [f"{offset + i + 1}. {card.front} : {card.back} ({deck_name})" for i, (deck_name, card) in enumerate(page.hits)]
+    navigation_buttons = []
+    if offset > 0:
+        navigation_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=encode(callbacks.SEARCH_PAGE, max(0, offset - ITEMS_PER_PAGE_CE))))
+    if page.has_next:
+        navigation_buttons.append(InlineKeyboardButton("➡️ Next", callback_data=encode(callbacks.SEARCH_PAGE, offset + ITEMS_PER_PAGE_CE)))
+    return "\n".join(lines), InlineKeyboardMarkup([navigation_buttons]) if navigation_buttons else None
+
+
+async def wait_for_typing(user_id):
+    # Telegram sends a query per keystroke; only the one the user stopped typing at is answered
+    await asyncio.sleep(INLINE_DEBOUNCE)
+
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # @bot <text> in any chat - the user's matching cards, picking one sends it to the chat
+    inline_query = update.inline_query
+    user_id = inline_query.from_user.id
+    latest_inline_query[user_id] = inline_query.id
+    await wait_for_typing(user_id)
+    if latest_inline_query.get(user_id) != inline_query.id:
+        return
+    index = await inline_cards.get(user_id)
+    if latest_inline_query.get(user_id) != inline_query.id:
+        return
+    latest_inline_query.pop(user_id)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    cards, has_next = index.search(inline_query.query, offset, INLINE_RESULTS)
+    results = [
+        InlineQueryResultArticle(
+            id=str(card_id),
+            title=front,
+            description=f"{back} ({deck_name})",
+            input_message_content=InputTextMessageContent(f"{front} : {back}")
         )
+        for card_id, deck_name, front, back in cards
+    ]
+    await inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True,
+        next_offset=str(offset + INLINE_RESULTS) if has_next else ""
+    )
+
+
+async def load_inline_index(user_id):
+    # Built on a database thread while the rows stream in
+    return await db.export_decks(user_id, None, PrefixIndex)
+
+
+async def export_decks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /export [csv|json] [all] - the current deck, or every deck when none is picked or "all" is given
+    user_id = update.message.from_user.id
+    args = [arg.lower() for arg in context.args or []]
+    export_format = "csv" if "csv" in args else "json"
+    session = user_general_session.get(user_id)
+    deck_name = session.get("deck_name") if session and "all" not in args else None
+    if deck_name is None and export_format == "json":
+        # Same name as the per-user files, so transfer_from_json_to_db.py can load it back
+        file_name = f"{user_id}.json.gz"
+    else:
+        file_name = f"{deck_name or 'decks'}.{export_format}.gz"
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "export")
+        count = await db.export_decks(user_id, deck_name, lambda rows: export_to_file(rows, path, export_format))
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f,
+                filename=file_name,
+                caption=f"Exported {count} cards" + (f" from Deck {deck_name}." if deck_name else ".")
+            )
+
+
+async def end_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Any command ends whatever the user was typing for
+    session = user_general_session.get(update.message.from_user.id)
+    if session:
+        session.pop("awaiting", None)
+
+
+def __deck_name(user_id):
+    # None when no deck is picked, or the session was evicted without a backend or moved to another worker
+    session = user_general_session.get(user_id)
+    return session.get("deck_name") if session else None
+
+
+async def reply_deck_name(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    deck_name = update.message.text  # The user's input
+    user_general_session[user_id].pop("awaiting", None)
+    if await db.add_deck(deck_name, user_id):
+        user_general_session[user_id]["deck_name"] = deck_name
+        keyboard = await get_keyboard()
+        await update.message.reply_text(f"Deck '{deck_name}' created. Current deck: '{deck_name}'", reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await update.message.reply_text(f"Deck '{deck_name}' already exists.")
+
+
+async def reply_delete_deck_name(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    deck_name = update.message.text
+    user_general_session[user_id].pop("awaiting", None)
+    if await db.get_deck(deck_name, user_id):
+        await db.delete_deck(deck_name, user_id)
+        inline_cards.invalidate(user_id)
+        if user_general_session[user_id].get("deck_name") == deck_name:
+            user_general_session[user_id].pop("deck_name")
+        await __send_together(context, update.message.reply_text(f"Deck '{deck_name}' deleted."), list_decks(update, context))
+    else:
+        await update.message.reply_text(f"Deck '{deck_name}' not found.")
+
+
+async def reply_front(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    deck_name = __deck_name(user_id)
+    if deck_name is None:
+        user_general_session[user_id].pop("awaiting", None)
+        await show_menu(update, context)
+        return
+    user_general_session[user_id]["front"] = update.message.text
+    user_general_session[user_id]["awaiting"] = AWAIT_BACK
+    await update.message.reply_text(
+        text="Type in BACK (Deck: " + deck_name + ")\n/cancel to stop adding (or any command)",
+        reply_markup=ForceReply()
+    )
+
+
+async def reply_back(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    deck_name = __deck_name(user_id)
+    front = user_general_session[user_id].get("front")
+    if deck_name is None or front is None:
+        user_general_session[user_id].pop("awaiting", None)
+        await show_menu(update, context)
         return
-    if query.data == "command_add_cards_to_deck":
-        await query.message.reply_text(
-            text="Type in FRONT (Deck: " + user_general_session[user_id]["deck_name"] + ")\n/cancel to stop adding (or any command)",
+    back = update.message.text
+    await db.add_card(deck_name, front, back, user_id)
+    inline_cards.invalidate(user_id)
+    user_general_session[user_id]["awaiting"] = AWAIT_FRONT
+    await __send_together(
+        context,
+        update.message.reply_text("Card has been added to Deck " + deck_name + " and saved."),
+        update.message.reply_text(
+            text="Type in FRONT (Deck: " + deck_name + ")\n/cancel to stop adding (or any command)",
             reply_markup=ForceReply()
         )
+    )
+
+
+async def reply_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    session = user_learning_sessions.get(user_id)
+    user_general_session.setdefault(user_id, {}).pop("awaiting", None)
+    if not session or session["current_step"] not in (4, 5):
+        await show_menu(update, context)
         return
-    if query.data == "command_delete_cards_in_deck" or query.data.startswith("page_ce_"):
-        page_ce = 0
-        if query.data.startswith("page_ce_"):
-            page_ce = query.data.split("page_ce_")[1]
-        cards = db.select_cards(user_general_session[user_id]["deck_name"], user_id)
-        deck_id = ""
-        for deck in db.get_all_decks(user_id):
-            if deck.name == user_general_session[user_id]["deck_name"]:
-                deck_id = deck.id
-        keyboard_ce = await __list_cards(cards, page_ce)
-        navigation_buttons_ce = []
-        navigation_buttons_ce.append(InlineKeyboardButton("🚫Exit", callback_data="deck_" + deck_id))
-        keyboard_ce.append(navigation_buttons_ce)
-        await query.edit_message_text(text="Delete card from Deck " + user_general_session[user_id]["deck_name"], reply_markup=InlineKeyboardMarkup(keyboard_ce))
-        return
-    if query.data == "command_switch_deck":
-        #db = DatabaseManager()
-        deck_ids = [deck.id for deck in sorted(db.get_all_decks(user_id), key=lambda deck: deck.name)]
-        deck_names = [deck.name for deck in sorted(db.get_all_decks(user_id), key=lambda deck: deck.name)]
-        if (user_id not in user_general_session):
-            user_general_session[user_id] = {}
-
-        user_general_session[user_id]["page"] = 0
-        page = user_general_session[user_id]["page"]
-        if deck_ids:
-            keyboard = await __list_decks(deck_ids, deck_names, page)
-            await query.edit_message_text(text="Pick a Deck", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            await query.edit_message_text("No decks available.")
-            await show_menu(query, context)
-        return
-    if query.data == "command_learn_deck":
-        deck_name = user_general_session[user_id]["deck_name"]
-        cards = db.select_cards_for_learning(deck_name, user_id)
-        if not cards:
-            await query.message.reply_text(f"No cards available for learning in deck '{deck_name}'.")
-            return
+    card = next(card for card in session["cards"] if card.id == session["question_card_id"])
+    expected = card.back if session["current_step"] == 4 else card.front
+    if update.message.text == expected:
+        session["progress"][card.id]["correct"] += 1
+        feedback = "Correct! ✅"
+    else:
+        session["progress"][card.id]["incorrect"] += 1
+        feedback = "Incorrect. ❌"
+    if SINGLE_MESSAGE_SESSIONS:
+        session["feedback"] = feedback
+        await present_next_card(update, user_id, context)
+    else:
+        await __send_together(context, update.message.reply_text(feedback), present_next_card(update, user_id, context))
 
-        user_learning_sessions[user_id] = {
-            "cards": cards,
-            "current_step": 1,
-            "current_card_index": 0,
-            "progress": {}
-        }
 
-        for card in cards:
-            user_learning_sessions[user_id]["progress"][card.id] = {}
-            user_learning_sessions[user_id]["progress"][card.id]["correct"] = 0
-            user_learning_sessions[user_id]["progress"][card.id]["incorrect"] = 0
+REPLY_HANDLERS = {
+    AWAIT_DECK_NAME: reply_deck_name,
+    AWAIT_DELETE_DECK_NAME: reply_delete_deck_name,
+    AWAIT_FRONT: reply_front,
+    AWAIT_BACK: reply_back,
+    AWAIT_ANSWER: reply_answer,
+}
 
-        await query.message.reply_text(f"Starting learning session for deck '{deck_name}'.")
 
-        # Proceed to the first card
-        await present_next_card(query, user_id, context)
+async def handle_name_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Plain text answers whatever the user was last prompted for
+    user_id = update.message.from_user.id
+    session = user_general_session.get(user_id)
+    handler = REPLY_HANDLERS.get(session.get("awaiting")) if session else None
+    if handler is None:
+        await show_menu(update, context)
         return
-    if query.data == "traverse_top_to_bot":
-        deck_name = user_general_session[user_id]["deck_name"]
-        cards = db.select_cards(deck_name, user_id)
-        if not cards:
-            await query.message.reply_text(f"No cards available for learning in deck '{deck_name}'.")
-            return
-        user_general_session[user_id]["traversing_cards"] = cards
-        user_general_session[user_id]["traverse_current_card_index"] = 0
-        await traverse_cards(query, user_id, False, context)
+    await handler(update, context, user_id)
 
+
+async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    await router.dispatch(update, context)
+
+
+async def expired_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if (query.from_user.id not in user_general_session):
+        user_general_session[query.from_user.id] = {}
+    keyboard = [
+        [InlineKeyboardButton("📁List Decks", callback_data=encode(callbacks.MENU_SWITCH_DECK)), InlineKeyboardButton("➕Add a Deck", callback_data=encode(callbacks.MENU_ADD_DECK))]
+    ]
+    await query.edit_message_text(text="This button has expired.\nMenu", reply_markup=InlineKeyboardMarkup(keyboard))
+
+router.fallback = expired_button
+
+
+@router.route(callbacks.MENU_ADD_DECK)
+async def prompt_add_deck(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if (query.from_user.id not in user_general_session):
+        user_general_session[query.from_user.id] = {}
+    user_general_session[query.from_user.id]["awaiting"] = AWAIT_DECK_NAME
+    await query.message.reply_text(
+        text="Enter Deck Name",
+        reply_markup=ForceReply()
+    )
+
+
+@router.route(callbacks.MENU_DELETE_DECK)
+async def prompt_delete_deck(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if (query.from_user.id not in user_general_session):
+        user_general_session[query.from_user.id] = {}
+    user_general_session[query.from_user.id]["awaiting"] = AWAIT_DELETE_DECK_NAME
+    await query.message.reply_text(
+        text="Enter Deck Name that you want to DELETE",
+        reply_markup=ForceReply()
+    )
+
+
+@router.route(callbacks.ADD_CARDS)
+async def prompt_add_cards(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    deck_name = __deck_name(user_id)
+    if deck_name is None:
+        await expired_button(update, context)
         return
-    if query.data == "traverse_bot_to_top":
-        deck_name = user_general_session[user_id]["deck_name"]
-        cards = db.select_cards(deck_name, user_id)
-        if not cards:
-            await query.message.reply_text(f"No cards available for learning in deck '{deck_name}'.")
-            return
-        user_general_session[user_id]["traversing_cards"] = cards
-        user_general_session[user_id]["traverse_current_card_index"] = 0
-        await traverse_cards(query, user_id, True, context)
+    user_general_session[user_id]["awaiting"] = AWAIT_FRONT
+    await query.message.reply_text(
+        text="Type in FRONT (Deck: " + deck_name + ")\n/cancel to stop adding (or any command)",
+        reply_markup=ForceReply()
+    )
+
 
+@router.route(callbacks.DELETE_CARDS)
+async def browse_cards_to_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    deck_name = __deck_name(user_id)
+    if deck_name is None:
+        await expired_button(update, context)
         return
-    if query.data == "show_and_traverse":
-        session = user_general_session[user_id]
-        traversing_cards = session["traversing_cards"]
-        current_traverse_index = session["traverse_current_card_index"] - 1
-        card = traversing_cards[current_traverse_index]
+    user_general_session[user_id]["card_page_cursors"] = [None]
+    await __show_card_page(query, user_id, 0, "Delete card from Deck " + deck_name)
 
-        await query.message.edit_text(text=query.message.text, reply_markup=None)
-        if not Boolean(session["traversing_is_reverse"]):
-            await query.message.reply_text(text=f"Actual: {card.back}")
-        elif Boolean(session["traversing_is_reverse"]):
-            await query.message.reply_text(text=f"Actual: {card.front}")
-        await traverse_cards(query, user_id, session["traversing_is_reverse"], context)
 
+@router.route(callbacks.CARD_PAGE)
+async def turn_card_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page_ce):
+    query = update.callback_query
+    user_id = query.from_user.id
+    deck_name = __deck_name(user_id)
+    if deck_name is None:
+        await expired_button(update, context)
         return
-    if query.data.startswith("deck_"):
-        if (user_id not in user_general_session):
-            user_general_session[user_id] = {}
+    await __show_card_page(query, user_id, int(page_ce), "Delete card from Deck " + deck_name)
 
-        deck_id = query.data.split("deck_")[1]
-        for deck in db.get_all_decks(user_id):
-            if deck.id == deck_id:
-                user_general_session[user_id]["deck_name"] = deck.name
-        keyboard = await get_keyboard()
-        await query.edit_message_text(
-            text="Current Deck: " + user_general_session[user_id]["deck_name"],
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+
+@router.route(callbacks.DELETE_CARD)
+async def delete_card(update: Update, context: ContextTypes.DEFAULT_TYPE, packed_card_id):
+    query = update.callback_query
+    user_id = query.from_user.id
+    deck_name = __deck_name(user_id)
+    if deck_name is None:
+        await expired_button(update, context)
         return
-    if query.data.startswith("page_"):
-        page = int(query.data.split("page_")[1])
-        deck_ids = [deck.id for deck in sorted(db.get_all_decks(user_id), key=lambda deck: deck.name)]
-        deck_names = [deck.name for deck in sorted(db.get_all_decks(user_id), key=lambda deck: deck.name)]
+    await db.delete_card(deck_name, unpack_id(packed_card_id), user_id)
+    inline_cards.invalidate(user_id)
+    await __show_card_page(query, user_id, user_general_session[user_id].get("card_page", 0), "Card has been deleted from Deck " + deck_name + ".\nDelete card from Deck " + deck_name)
+
+
+@router.route(callbacks.MENU_SWITCH_DECK)
+async def switch_deck(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    decks = await db.get_all_decks(user_id)
+    deck_ids = [deck.id for deck in decks]
+    deck_names = [deck.name for deck in decks]
+    if (user_id not in user_general_session):
+        user_general_session[user_id] = {}
+
+    user_general_session[user_id]["page"] = 0
+    page = user_general_session[user_id]["page"]
+    if deck_ids:
         keyboard = await __list_decks(deck_ids, deck_names, page)
         await query.edit_message_text(text="Pick a Deck", reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await query.edit_message_text("No decks available.")
+        await show_menu(query, context)
+
+
+@router.route(callbacks.DECK_PAGE)
+async def turn_deck_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    query = update.callback_query
+    decks = await db.get_all_decks(query.from_user.id)
+    deck_ids = [deck.id for deck in decks]
+    deck_names = [deck.name for deck in decks]
+    keyboard = await __list_decks(deck_ids, deck_names, int(page))
+    await query.edit_message_text(text="Pick a Deck", reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+@router.route(callbacks.PICK_DECK)
+async def pick_deck(update: Update, context: ContextTypes.DEFAULT_TYPE, packed_deck_id):
+    query = update.callback_query
+    user_id = query.from_user.id
+    if (user_id not in user_general_session):
+        user_general_session[user_id] = {}
+
+    deck = await db.get_deck_by_id(unpack_id(packed_deck_id), user_id)
+    if not deck:
+        await expired_button(update, context)
         return
-    if query.data.startswith("delete_card_"):
-        id = (query.data.split("delete_card_")[1])
-        db.delete_card(user_general_session[user_id]["deck_name"], id, user_id)
-        cards = db.select_cards(user_general_session[user_id]["deck_name"], user_id)
-        deck_id = ""
-        for deck in db.get_all_decks(user_id):
-            if deck.name == user_general_session[user_id]["deck_name"]:
-                deck_id = deck.id
-        keyboard_ce = await __list_cards(cards, 0)
-        navigation_buttons_ce = []
-        navigation_buttons_ce.append(InlineKeyboardButton("🚫Exit", callback_data="deck_" + deck_id))
-        keyboard_ce.append(navigation_buttons_ce)
-        await query.edit_message_text(text="Card has been deleted from Deck " + user_general_session[user_id]["deck_name"] + ".\nDelete card from Deck " + user_general_session[user_id]["deck_name"], reply_markup=InlineKeyboardMarkup(keyboard_ce))
+    user_general_session[user_id]["deck_name"] = deck.name
+    keyboard = await get_keyboard()
+    await query.edit_message_text(
+        text="Current Deck: " + user_general_session[user_id]["deck_name"],
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+@router.route(callbacks.LEARN)
+async def start_learning(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    deck_name = __deck_name(user_id)
+    if deck_name is None:
+        await expired_button(update, context)
+        return
+    cards = await db.select_cards_for_learning(deck_name, user_id)
+    if not cards:
+        await query.message.reply_text(f"No cards available for learning in deck '{deck_name}'.")
         return
-    if query.data.startswith("correct_"):
-        user_learning_sessions[user_id]["progress"][query.data.split("correct_")[1]]["correct"] += 1
-        await query.edit_message_text("Correct! ✅")
-    if query.data.startswith("incorrect"):
-        user_learning_sessions[user_id]["progress"][query.data.split("incorrect_")[1]]["incorrect"] += 1
-        await query.edit_message_text("Incorrect. ❌")
 
-    # Proceed to the next card
+    user_learning_sessions[user_id] = {
+        "deck_name": deck_name,
+        "cards": cards,
+        "current_step": 1,
+        "current_card_index": 0,
+        "progress": {},
+        "api_calls": api_calls.counter.get(user_id)
+    }
+
+    for card in cards:
+        user_learning_sessions[user_id]["progress"][card.id] = {}
+        user_learning_sessions[user_id]["progress"][card.id]["correct"] = 0
+        user_learning_sessions[user_id]["progress"][card.id]["incorrect"] = 0
+
+    start_message = f"Starting learning session for deck '{deck_name}'."
+    if SINGLE_MESSAGE_SESSIONS:
+        # The menu message becomes the session's message
+        __take_over_message(user_learning_sessions[user_id], query.message, start_message)
+        await present_next_card(query, user_id, context)
+    else:
+        # Proceed to the first card
+        await __send_together(context, query.message.reply_text(start_message), present_next_card(query, user_id, context))
+
+
+@router.route(callbacks.ANSWER)
+async def answer_option(update: Update, context: ContextTypes.DEFAULT_TYPE, question, option):
+    query = update.callback_query
+    user_id = query.from_user.id
     session = user_learning_sessions.get(user_id)
+    if not session or session.get("question") != int(question) or session.get("correct_option") is None:
+        # A button from an earlier or already answered question, or a finished session
+        return
+    if int(option) == session.pop("correct_option"):
+        session["progress"][session["question_card_id"]]["correct"] += 1
+        feedback = "Correct! ✅"
+    else:
+        session["progress"][session["question_card_id"]]["incorrect"] += 1
+        feedback = "Incorrect. ❌"
+    if SINGLE_MESSAGE_SESSIONS:
+        session["feedback"] = feedback
+    else:
+        await query.edit_message_text(feedback)
+
+    # Proceed to the next card
     await present_next_card(query, user_id, context)
 
 
-async def __list_cards(cards, page_ce):
-    items_per_page_ce = 5
-    total_pages_ce = int(len(cards) / items_per_page_ce)
-    start_index_ce = int(page_ce) * items_per_page_ce
-    end_index_ce = start_index_ce + items_per_page_ce
-    keyboard_ce = [[InlineKeyboardButton(card.front + ' : ' + card.back, callback_data=f"delete_card_{card.id}")] for card in cards[start_index_ce:end_index_ce]]
+async def __start_traversal(update: Update, context: ContextTypes.DEFAULT_TYPE, is_reversed):
+    query = update.callback_query
+    user_id = query.from_user.id
+    deck_name = __deck_name(user_id)
+    if deck_name is None:
+        await expired_button(update, context)
+        return
+    if not (await db.select_cards_page(deck_name, user_id, None, 1, False)).cards:
+        await query.message.reply_text(f"No cards available for learning in deck '{deck_name}'.")
+        return
+    user_general_session[user_id]["traverse_after"] = None
+    user_general_session[user_id]["traverse_has_next"] = True
+    user_general_session[user_id]["api_calls"] = api_calls.counter.get(user_id)
+    if SINGLE_MESSAGE_SESSIONS:
+        __take_over_message(user_general_session[user_id], query.message)
+    await traverse_cards(query, user_id, is_reversed, context)
+
+
+def __take_over_message(session, message, feedback=None):
+    session["chat_id"] = message.chat_id
+    session["message_id"] = message.message_id
+    if feedback:
+        session["feedback"] = feedback
+
+
+@router.route(callbacks.TRAVERSE_FRONT)
+async def traverse_front_to_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await __start_traversal(update, context, False)
+
+
+@router.route(callbacks.TRAVERSE_BACK)
+async def traverse_back_to_front(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await __start_traversal(update, context, True)
+
+
+@router.route(callbacks.REVEAL)
+async def reveal_and_traverse(update: Update, context: ContextTypes.DEFAULT_TYPE, position=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    session = user_general_session.get(user_id)
+    card = session.get("traversing_card") if session else None
+    if card is None:
+        await expired_button(update, context)
+        return
+    if position is not None and int(position) != session.get("traverse_position"):
+        # Already revealed
+        return
+
+    actual = card.front if session["traversing_is_reverse"] else card.back
+    if SINGLE_MESSAGE_SESSIONS:
+        # The answer is shown above the next card in the same message
+        question = card.back if session["traversing_is_reverse"] else card.front
+        session["feedback"] = f"'{question}' → {actual}"
+    else:
+        await query.message.edit_text(text=query.message.text, reply_markup=None)
+        await query.message.reply_text(text=f"Actual: {actual}")
+    await traverse_cards(query, user_id, session["traversing_is_reverse"], context)
+
+
+@router.route(callbacks.SEARCH_PAGE)
+async def turn_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE, offset):
+    query = update.callback_query
+    user_id = query.from_user.id
+    session = user_general_session.get(user_id)
+    if not session or not session.get("search_query"):
+        await expired_button(update, context)
+        return
+    text, reply_markup = await __search_page(user_id, session["search_query"], int(offset))
+    await query.edit_message_text(text=text, reply_markup=reply_markup)
+
+
+async def __show_card_page(query, user_id, page_ce, text):
+    # Page n starts after the last card of page n - 1, cursors[n] holds that keyset position
+    session = user_general_session[user_id]
+    deck_name = session["deck_name"]
+    cursors = session.get("card_page_cursors") or [None]
+    if page_ce >= len(cursors):
+        page_ce, cursors = 0, [None]
+    card_page = await db.select_cards_page(deck_name, user_id, cursors[page_ce], ITEMS_PER_PAGE_CE)
+    if not card_page.cards and page_ce > 0:
+        # The last card of this page was deleted
+        page_ce -= 1
+        card_page = await db.select_cards_page(deck_name, user_id, cursors[page_ce], ITEMS_PER_PAGE_CE)
+    del cursors[page_ce + 1:]
+    if card_page.has_next:
+        cursors.append(card_page.next_after)
+    session["card_page_cursors"] = cursors
+    session["card_page"] = page_ce
+
+    deck = await db.get_deck(deck_name, user_id)
+    deck_id = deck.id if deck else ""
+    keyboard_ce = await __list_cards(card_page.cards, page_ce, card_page.has_next)
+    navigation_buttons_ce = []
+    navigation_buttons_ce.append(InlineKeyboardButton("🚫Exit", callback_data=encode(callbacks.PICK_DECK, pack_id(deck_id)) if deck_id else encode(callbacks.MENU_SWITCH_DECK)))
+    keyboard_ce.append(navigation_buttons_ce)
+    await query.edit_message_text(text=f"{text} ({card_page.total} cards)", reply_markup=InlineKeyboardMarkup(keyboard_ce))
+
+
+async def __list_cards(cards, page_ce, has_next):
+    keyboard_ce = [[InlineKeyboardButton(card.front + ' : ' + card.back, callback_data=encode(callbacks.DELETE_CARD, pack_id(card.id)))] for card in cards]
     navigation_buttons_ce = []
-    if int(page_ce) > 0:
-        navigation_buttons_ce.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"page_ce_{int(page_ce) - 1}"))
-    if int(page_ce) < total_pages_ce:
-        navigation_buttons_ce.append(InlineKeyboardButton("➡️ Next", callback_data=f"page_ce_{int(page_ce) + 1}"))
+    if page_ce > 0:
+        navigation_buttons_ce.append(InlineKeyboardButton("⬅️ Previous", callback_data=encode(callbacks.CARD_PAGE, page_ce - 1)))
+    if has_next:
+        navigation_buttons_ce.append(InlineKeyboardButton("➡️ Next", callback_data=encode(callbacks.CARD_PAGE, page_ce + 1)))
     if navigation_buttons_ce:
         keyboard_ce.append(navigation_buttons_ce)
     return keyboard_ce
@@ -523,18 +936,18 @@ async def __list_decks(deck_ids, deck_names, page):
     keyboard = []
     for i in range(len(deck_ids)):
         if i >= start_index and i <= end_index:
-            keyboard.append([InlineKeyboardButton(deck_names[i], callback_data=f"deck_{deck_ids[i]}")])
+            keyboard.append([InlineKeyboardButton(deck_names[i], callback_data=encode(callbacks.PICK_DECK, pack_id(deck_ids[i])))])
     navigation_buttons = []
     if page > 0:
-        navigation_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"page_{page - 1}"))
+        navigation_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=encode(callbacks.DECK_PAGE, page - 1)))
     if page < total_pages:
-        navigation_buttons.append(InlineKeyboardButton("➡️ Next", callback_data=f"page_{page + 1}"))
+        navigation_buttons.append(InlineKeyboardButton("➡️ Next", callback_data=encode(callbacks.DECK_PAGE, page + 1)))
     if navigation_buttons:
         keyboard.append(navigation_buttons)
 
     editing_buttons = []
-    editing_buttons.append(InlineKeyboardButton("➕Add a Deck", callback_data=f"command_add_deck"))
-    editing_buttons.append(InlineKeyboardButton("➖Delete a Deck", callback_data=f"command_delete_deck"))
+    editing_buttons.append(InlineKeyboardButton("➕Add a Deck", callback_data=encode(callbacks.MENU_ADD_DECK)))
+    editing_buttons.append(InlineKeyboardButton("➖Delete a Deck", callback_data=encode(callbacks.MENU_DELETE_DECK)))
 
     keyboard.append(editing_buttons)
     return keyboard
@@ -547,18 +960,141 @@ async def generate_options(correct_card, all_cards, attribute):
     return options
 
 
-def main():
-    bot_token = os.getenv("BOT_TOKEN")
-    app = ApplicationBuilder().token(bot_token).build()
+async def load_sessions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Before any other handler, so they find spilled sessions in memory
+    if update.effective_user:
+        user_id = update.effective_user.id
+        await user_learning_sessions.load(user_id)
+        await user_general_session.load(user_id)
+        session = user_learning_sessions.get(user_id)
+        if session and None in session["cards"]:
+            # A card of the session was deleted while it was spilled
+            user_learning_sessions.pop(user_id)
+
+
+async def find_session_cards(user_id, state):
+    # Sessions are spilled with card ids only, their cards come back from the session's deck
+    deck_name = state.get("deck_name")
+    if not deck_name:
+        return {}
+    return {card.id: card for card in await db.select_cards(deck_name, user_id)}
+
+
+async def flush_sessions(app):
+    await user_learning_sessions.flush()
+    await user_general_session.flush()
+
+
+async def release_sessions(predicate):
+    """
+    Spill the sessions of the users matching predicate; see sharding.run_worker.
+    """
+    inline_cards.release(predicate)
+    return await user_learning_sessions.release(predicate) + await user_general_session.release(predicate)
+
+
+def configure(database=None):
+    """
+    Connect the handlers to their database and session stores. Called once before the application starts.
+    :param database: An AsyncDatabaseManager or a stand-in with the same methods; opens STORAGE_BACKEND when None.
+    """
+    global db, session_backend, user_learning_sessions, user_general_session, inline_cards
+    db = database or AsyncDatabaseManager()
+    manager = getattr(db, "manager", None)
+    session_backend = create_session_backend(getattr(manager, "pool", None))
+    # Spilled sessions are read and written on the database threads
+    executor = getattr(db, "executor", None)
+    user_learning_sessions = SessionStore("learning", session_backend, executor=executor, find_cards=find_session_cards)
+    user_general_session = SessionStore("general", session_backend, executor=executor, find_cards=find_session_cards)
+    inline_cards = InlineIndexCache(load_inline_index)
+
+
+def build_application(builder):
+    """
+    Build the application from a configured ApplicationBuilder and register the handlers.
+    """
+    app = builder.build()
+    if session_backend is not None:
+        app.add_handler(TypeHandler(Update, load_sessions), group=-2)
+    app.add_handler(MessageHandler(filters.COMMAND, end_conversation), group=-1)
     app.add_handler(CommandHandler("start", show_menu))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("menu", show_menu))
     app.add_handler(CommandHandler("list", list_decks))
     app.add_handler(CommandHandler("cancel", cancel_adding))
+    app.add_handler(CommandHandler("export", export_decks))
+    app.add_handler(CommandHandler("reminders", set_reminders))
+    app.add_handler(CommandHandler("search", search_cards))
     app.add_handler(CallbackQueryHandler(handle_answer))
+    # Not blocking: a query waiting out the debounce must not hold up the updates behind it
+    app.add_handler(InlineQueryHandler(inline_search, block=False))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_name_reply))
+    app.add_handler(MessageHandler(filters.Document.ALL, import_document))
+    if metrics.ENABLED:
+        metrics.instrument_handlers(app)
+        router.instrument(metrics.timed_handler)
+    # Outermost, so handler timings exclude the wait for the user's lock
+    serialize_handlers(app)
+    return app
+
+
+async def start_metrics(app):
+    manager = getattr(db, "manager", None)
+    metrics.gauge("session_store_entries", "Sessions held in memory", lambda: {
+        ("learning",): len(user_learning_sessions),
+        ("general",): len(user_general_session),
+    }, ("store",))
+    metrics.gauge("inline_index_users", "Users whose inline search index is in memory", lambda: len(inline_cards))
+    if getattr(manager, "deck_cache", None) is not None:
+        metrics.gauge("deck_cache_users", "Users whose decks are cached", lambda: len(manager.deck_cache))
+    if getattr(manager, "pool", None) is not None:
+        metrics.gauge("db_pool_connections", "Database connections", lambda: {
+            (state,): value for state, value in manager.pool.stats().items()
+        }, ("state",))
+    if app.bot.rate_limiter is outbox:
+        metrics.gauge("outbox", "Outbound queue depth, counters and latency in seconds", lambda: {
+            (name,): value for name, value in outbox.stats().items()
+        }, ("stat",))
+    app.bot_data["metrics_server"] = await metrics.start_server()
+
+
+def main():
+    configure()
+    bot_token = os.getenv("BOT_TOKEN")
+    builder = ApplicationBuilder().token(bot_token).post_shutdown(flush_sessions)
+    if metrics.ENABLED:
+        # Prometheus-style endpoint on METRICS_HOST:METRICS_PORT
+        builder.post_init(start_metrics)
+    # Counts Bot API calls per user, reported at the end of each session
+    builder.request(CountingRequest())
+    if os.getenv("OUTBOX_ENABLED", "1") == "1":
+        # Queues, merges, throttles and retries everything the handlers and jobs send
+        builder.rate_limiter(outbox)
+    # Different users are processed in parallel, each user's updates strictly in order
+    builder.concurrent_updates(PerUserUpdateProcessor(int(os.getenv("CONCURRENT_UPDATES", "32"))))
+    if os.getenv("BOT_API_BASE_URL"):
+        # e.g. http://127.0.0.1:8081/bot to run against webhook_stub.py
+        builder.base_url(os.getenv("BOT_API_BASE_URL"))
+    app = build_application(builder)
+    # Sharded workers would each scan every shard, so there only the one started with
+    # REMINDERS_ENABLED=1 sends reminders
+    default_reminders = "0" if os.getenv("BOT_MODE", "polling") == "worker" else "1"
+    if os.getenv("REMINDERS_ENABLED", default_reminders) == "1":
+        ReviewReminders(db).schedule(app.job_queue)
     print("Bot is running...")
-    app.run_polling()
+    if os.getenv("BOT_MODE", "polling") == "worker":
+        # Behind sharding.py's dispatcher, which owns the webhook
+        asyncio.run(sharding.run_worker(app, release_sessions))
+    elif os.getenv("BOT_MODE", "polling") == "webhook":
+        app.run_webhook(
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            url_path=os.getenv("WEBHOOK_PATH", ""),
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+            webhook_url=os.getenv("WEBHOOK_URL")
+        )
+    else:
+        app.run_polling()
 
 
 def all_commands():
@@ -567,6 +1103,11 @@ def all_commands():
 /help - Show available commands
 /menu - Show menu
 /list - List all decks
+/export [csv|json] [all] - Export the current deck (or all decks) as a file
+/reminders on|off - Daily reminders when cards are due
+/search <text> - Find cards in all decks
+@<bot> <text> in any chat - Send one of your cards (inline mode must be enabled with @BotFather)
+Send a CSV/TSV file (FRONT, BACK columns) to import cards into the current deck
     """
 
 
@@ -0,0 +1,88 @@
+import base64
+import uuid
+
+
+# Bump when the layout changes so buttons left in old chats are recognised as expired
+VERSION = "1"
+SEPARATOR = "|"
+
+# Short action codes carried in callback_data
+MENU_SWITCH_DECK = "sd"
+MENU_ADD_DECK = "ad"
+MENU_DELETE_DECK = "dd"
+DECK_PAGE = "dp"
+PICK_DECK = "d"
+ADD_CARDS = "ac"
+DELETE_CARDS = "dc"
+CARD_PAGE = "cp"
+DELETE_CARD = "x"
+LEARN = "l"
+ANSWER = "a"
+TRAVERSE_FRONT = "tf"
+TRAVERSE_BACK = "tb"
+REVEAL = "r"
+SEARCH_PAGE = "sp"
+
+
+def pack_id(value):
+    """
+    Pack a UUID string into 22 URL-safe characters.
+    """
+    return base64.urlsafe_b64encode(uuid.UUID(value).bytes).rstrip(b"=").decode("ascii")
+
+
+def unpack_id(value):
+    return str(uuid.UUID(bytes=base64.urlsafe_b64decode(value + "==")))
+
+
+def encode(action, *args):
+    """
+    Build callback_data such as "1d|<packed uuid>" or "1cp|3".
+    """
+    data = VERSION + SEPARATOR.join([action] + [str(arg) for arg in args])
+    if len(data.encode("utf-8")) > 64:
+        raise ValueError(f"callback_data for '{action}' exceeds Telegram's 64 byte limit")
+    return data
+
+
+def decode(data):
+    """
+    :return: (action, args), or (None, []) for data from another version or format.
+    """
+    if not data or not data.startswith(VERSION):
+        return None, []
+    action, *args = data[len(VERSION):].split(SEPARATOR)
+    return action, args
+
+
+class CallbackRouter:
+    def __init__(self, fallback=None):
+        """
+        Maps action codes to handlers called as handler(update, context, *args).
+        :param fallback: Called as fallback(update, context) for unknown or expired data.
+        """
+        self._handlers = {}
+        self.fallback = fallback
+
+    def route(self, action):
+        def register(handler):
+            if action in self._handlers:
+                raise ValueError(f"Action '{action}' is already routed")
+            self._handlers[action] = handler
+            return handler
+        return register
+
+    def instrument(self, wrap):
+        """
+        Replace every routed handler with wrap(handler, name), e.g. metrics.timed_handler.
+        """
+        self._handlers = {action: wrap(handler, handler.__name__) for action, handler in self._handlers.items()}
+
+    async def dispatch(self, update, context):
+        action, args = decode(update.callback_query.data)
+        handler = self._handlers.get(action)
+        if handler is None:
+            if self.fallback is not None:
+                await self.fallback(update, context)
+            return
+        await handler(update, context, *args)
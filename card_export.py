@@ -0,0 +1,70 @@
+from storage import timestamp
+import csv
+import gzip
+import json
+
+
+CSV_COLUMNS = ["deck", "front", "back", "level", "last_revised", "id"]
+
+
+def write_csv(rows, f):
+    """
+    :param rows: (deck_id, deck_name, card_id, front, back, last_revised, level, ease, interval_days,
+                 due_at) tuples; card columns are None for an empty deck.
+    """
+    writer = csv.writer(f)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for deck_id, deck_name, card_id, front, back, last_revised, level, *_ in rows:
+        if card_id is None:
+            continue
+        writer.writerow([deck_name, front, back, level, timestamp(last_revised), str(card_id)])
+        count += 1
+    return count
+
+
+def write_json(rows, f):
+    """
+    Write the per-user file layout used by services.py (a list of Deck.to_dict()),
+    one card at a time. Rows must be grouped by deck.
+    """
+    count = 0
+    current_deck = None
+    f.write("[")
+    for deck_id, deck_name, card_id, front, back, last_revised, level, ease, interval, due_at in rows:
+        if deck_id != current_deck:
+            if current_deck is not None:
+                f.write("]},")
+            current_deck = deck_id
+            f.write("\n" + json.dumps({"name": deck_name, "id": str(deck_id)}, ensure_ascii=False)[:-1] + ', "cards": [')
+            first_card = True
+        if card_id is None:
+            continue
+        if not first_card:
+            f.write(",")
+        first_card = False
+        f.write("\n" + json.dumps({
+            "front": front,
+            "back": back,
+            "id": str(card_id),
+            "last_revised": timestamp(last_revised),
+            "level": level,
+            "ease": ease,
+            "interval": interval,
+            "due_at": timestamp(due_at)
+        }, ensure_ascii=False))
+        count += 1
+    if current_deck is not None:
+        f.write("]}")
+    f.write("\n]\n")
+    return count
+
+
+def export_to_file(rows, path, export_format):
+    """
+    Stream rows into a gzip-compressed CSV or JSON file.
+    :return: The number of cards written.
+    """
+    writer = write_csv if export_format == "csv" else write_json
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        return writer(rows, f)
@@ -0,0 +1,60 @@
+import csv
+import os
+
+
+MAX_FIELD_LENGTH = 1024
+ANKI_SEPARATORS = {"tab": "\t", "comma": ",", "semicolon": ";", "pipe": "|", "space": " "}
+
+
+class CardFileReader:
+    def __init__(self, path, file_name=None):
+        """
+        Stream (front, back) pairs out of a CSV, TSV or Anki text export, one line at a time.
+        Anki "#key:value" header lines and a "front,back" header row are honoured, extra columns are ignored and rows
+        without both sides are counted in `invalid` instead of being yielded.
+        :param file_name: The original name, used to guess the separator from its extension.
+        """
+        self.path = path
+        self.file_name = file_name or os.path.basename(path)
+        self.invalid = 0
+        self.read = 0
+
+    def _guess_delimiter(self, sample):
+        extension = os.path.splitext(self.file_name)[1].lower()
+        if extension in (".tsv", ".txt") or "\t" in sample:
+            return "\t"
+        try:
+            return csv.Sniffer().sniff(sample, delimiters=",;|").delimiter
+        except csv.Error:
+            return ","
+
+    def __iter__(self):
+        with open(self.path, "r", encoding="utf-8-sig", newline="") as f:
+            delimiter = None
+            # Anki exports start with directives such as "#separator:tab"
+            line = f.readline()
+            while line.startswith("#"):
+                key, _, value = line[1:].strip().partition(":")
+                if key == "separator":
+                    delimiter = ANKI_SEPARATORS.get(value.lower(), value[:1] or None)
+                line = f.readline()
+            if delimiter is None:
+                delimiter = self._guess_delimiter(line)
+
+            def lines():
+                yield line
+                yield from f
+
+            for row in csv.reader(lines(), delimiter=delimiter):
+                if not row:
+                    continue
+                self.read += 1
+                front = row[0].strip() if len(row) > 0 else ""
+                back = row[1].strip() if len(row) > 1 else ""
+                if self.read == 1 and (front.lower(), back.lower()) == ("front", "back"):
+                    # Header row
+                    continue
+                if not front or not back or len(front) > MAX_FIELD_LENGTH or len(back) > MAX_FIELD_LENGTH:
+                    self.invalid += 1
+                    continue
+                yield front, back
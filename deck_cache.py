@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import threading
+import time
+import os
+
+
+class DeckIndex:
+    def __init__(self, decks):
+        self.decks = sorted(decks, key=lambda deck: deck.name)
+        self.by_name = {deck.name: deck for deck in self.decks}
+        self.by_id = {deck.id: deck for deck in self.decks}
+        self.loaded_at = time.monotonic()
+
+
+class DeckCache:
+    def __init__(self, max_users=None, ttl=None):
+        """
+        In-process LRU cache of each user's deck list.
+        :param max_users: Users kept before the least recently used is evicted (DECK_CACHE_SIZE).
+        :param ttl: Seconds an entry is trusted before it is reloaded (DECK_CACHE_TTL).
+        """
+        self.max_users = max_users or int(os.getenv("DECK_CACHE_SIZE", "10000"))
+        self.ttl = ttl or float(os.getenv("DECK_CACHE_TTL", "300"))
+        self._entries = OrderedDict()
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        key = str(user_id)
+        with self._lock:
+            index = self._entries.get(key)
+            if index is None:
+                return None
+            if time.monotonic() - index.loaded_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return index
+
+    def load(self, user_id, loader):
+        """
+        Return the cached index for a user, calling loader() for the deck list on a miss.
+        A load that raced with an invalidation is returned but not cached.
+        """
+        index = self.get(user_id)
+        if index is not None:
+            return index
+        with self._lock:
+            version = self._version
+        index = DeckIndex(loader())
+        with self._lock:
+            if version == self._version:
+                self._entries[str(user_id)] = index
+                self._entries.move_to_end(str(user_id))
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        return index
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._version += 1
+            self._entries.pop(str(user_id), None)
+
+    def __len__(self):
+        return len(self._entries)
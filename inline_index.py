@@ -0,0 +1,126 @@
+from bisect import bisect_left
+from collections import OrderedDict
+import asyncio
+import os
+import re
+
+
+_WORD = re.compile(r"\w+")
+
+
+class PrefixIndex:
+    def __init__(self, rows):
+        """
+        One user's cards, searchable as the user types: every word of the query must start a word
+        of the card's front, back or deck name.
+        :param rows: Rows of iter_export_rows; cards of a deck are skipped when the deck is empty.
+        """
+        self.cards = []  # (card_id, deck_name, front, back)
+        self._fronts = []  # lowercase fronts, for ranking
+        words = []
+        for row in rows:
+            deck_name, card_id, front, back = row[1], row[2], row[3], row[4]
+            if card_id is None:
+                continue
+            position = len(self.cards)
+            self.cards.append((card_id, deck_name, front, back))
+            self._fronts.append(front.lower())
+            words.extend((word, position) for word in set(_WORD.findall(f"{front} {back} {deck_name}".lower())))
+        words.sort()
+        # Parallel sorted lists, so a prefix is two bisections away
+        self._words = [word for word, _ in words]
+        self._positions = [position for _, position in words]
+        self._order = sorted(range(len(self.cards)), key=lambda position: (self._fronts[position], position))
+
+    def __len__(self):
+        return len(self.cards)
+
+    def _starting_with(self, prefix):
+        start = bisect_left(self._words, prefix)
+        end = bisect_left(self._words, prefix + "\U0010ffff", start)
+        return set(self._positions[start:end])
+
+    def search(self, query, offset=0, limit=50):
+        """
+        Cards whose front starts with the query come first, then shorter fronts.
+        :return: (list of (card_id, deck_name, front, back), whether more cards match after them)
+        """
+        prefixes = set(_WORD.findall(query.lower()))
+        if not prefixes:
+            matches = self._order
+        else:
+            positions = None
+            # Longer prefixes match fewer words, so the intersection shrinks fastest
+            for prefix in sorted(prefixes, key=len, reverse=True):
+                found = self._starting_with(prefix)
+                positions = found if positions is None else positions & found
+                if not positions:
+                    return [], False
+            needle = query.strip().lower()
+            fronts = self._fronts
+            matches = sorted(positions, key=lambda position: (
+                not fronts[position].startswith(needle), len(fronts[position]), fronts[position], position
+            ))
+        return [self.cards[position] for position in matches[offset:offset + limit]], len(matches) > offset + limit
+
+
+class InlineIndexCache:
+    def __init__(self, load, max_users=None):
+        """
+        A PrefixIndex per user kept warm in memory, the least recently used dropped first.
+        Only a miss reaches the database; callers invalidate a user whenever their cards change.
+        :param load: Coroutine function user_id -> PrefixIndex, run once per miss however many
+                     queries wait for it.
+        :param max_users: Indexes kept in memory (INLINE_INDEX_USERS).
+        """
+        self.load = load
+        self.max_users = max_users or int(os.getenv("INLINE_INDEX_USERS", "1000"))
+        self._indexes = OrderedDict()  # user_id -> PrefixIndex
+        self._loading = {}  # user_id -> task building the user's index
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id):
+        index = self._indexes.get(user_id)
+        if index is not None:
+            self._indexes.move_to_end(user_id)
+            self.hits += 1
+            return index
+        task = self._loading.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self.load(user_id))
+            self._loading[user_id] = task
+            task.add_done_callback(lambda done: self._store(user_id, done))
+        # A query cancelled while waiting must not cancel the load the others wait for
+        return await asyncio.shield(task)
+
+    def _store(self, user_id, task):
+        if self._loading.get(user_id) is not task:
+            return  # Invalidated while loading: the index may miss the change
+        del self._loading[user_id]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._indexes[user_id] = task.result()
+        while len(self._indexes) > self.max_users:
+            self._indexes.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """
+        Drop the user's index after their cards changed; the next query rebuilds it.
+        """
+        self._indexes.pop(user_id, None)
+        self._loading.pop(user_id, None)
+
+    def release(self, predicate):
+        """
+        Drop the indexes of the users matching predicate, e.g. users now served by another worker.
+        :return: The number of indexes dropped.
+        """
+        released = [user_id for user_id in set(self._indexes) | set(self._loading) if predicate(user_id)]
+        for user_id in released:
+            self.invalidate(user_id)
+        return len(released)
+
+    def __len__(self):
+        return len(self._indexes)
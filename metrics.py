@@ -0,0 +1,295 @@
+"""
+Hot-path instrumentation exposed in the Prometheus text format.
+
+Everything is off unless METRICS_ENABLED=1. When off, handlers are not wrapped and the hooks in
+the database layer, the update processor and the Bot API request reduce to one flag check.
+"""
+from contextvars import ContextVar
+import asyncio
+import functools
+import os
+import threading
+import time
+
+
+ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+# Updates slower than this are logged with their action and query breakdown
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "1.0"))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    labels = _format_labels(self.labels + ("le",), label_values + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labels + ("le",), label_values + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+                labels = _format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {series[-2]}")
+                lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, read, labels=()):
+        """
+        :param read: Called at scrape time; returns a number, or a dict of label values -> number.
+        """
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = labels
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+_registry = []
+
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def gauge(name, help, read, labels=()):
+    return _register(Gauge(name, help, read, labels))
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+update_seconds = _register(Histogram("bot_update_seconds", "Time to process one update", ("kind",)))
+slow_updates = _register(Counter("bot_slow_updates_total", "Updates slower than SLOW_UPDATE_SECONDS", ("kind",)))
+handler_seconds = _register(Histogram("bot_handler_seconds", "Time spent in each handler", ("handler",)))
+handler_errors = _register(Counter("bot_handler_errors_total", "Handlers that raised", ("handler",)))
+db_method_seconds = _register(Histogram("db_method_seconds", "DatabaseManager method time, queueing included", ("method",)))
+db_method_queries = _register(Counter("db_method_queries_total", "SQL statements executed per DatabaseManager method", ("method",)))
+db_query_seconds = _register(Histogram("db_query_seconds", "Time of single SQL statements", ("statement",)))
+bot_api_seconds = _register(Histogram("bot_api_seconds", "Bot API request latency", ("method",)))
+
+
+# Per-update trace: the database calls (and Bot API calls made from the update's task) of the update
+# being processed, for slow-update logging
+current_trace = ContextVar("current_trace", default=None)
+# Statements executed by the DatabaseManager method running on this executor thread
+_thread = threading.local()
+
+
+class UpdateTrace:
+    __slots__ = ("db_calls", "api_calls")
+
+    def __init__(self):
+        self.db_calls = []  # (method, seconds, statements)
+        self.api_calls = []  # (method, seconds)
+
+
+def describe_update(update):
+    """
+    :return: (kind, detail): "callback" and the decoded action, "command" and the command, or "message".
+    """
+    if getattr(update, "callback_query", None) is not None:
+        from callbacks import decode
+        action, args = decode(update.callback_query.data or "")
+        return "callback", f"action={action} args={args}"
+    message = getattr(update, "message", None)
+    if message is not None and message.text and message.text.startswith("/"):
+        return "command", message.text.split()[0]
+    if message is not None and message.document is not None:
+        return "document", message.document.file_name
+    return "message", ""
+
+
+async def observe_update(update, coroutine):
+    """
+    Await the processing of one update, timing it and logging it when slow.
+    """
+    trace = UpdateTrace()
+    current_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        await coroutine
+    finally:
+        elapsed = time.perf_counter() - started
+        kind, detail = describe_update(update)
+        update_seconds.observe(elapsed, kind)
+        if elapsed >= SLOW_UPDATE_SECONDS:
+            slow_updates.inc(kind)
+            db = ", ".join(f"{method} {seconds * 1000:.0f}ms/{statements}q" for method, seconds, statements in trace.db_calls)
+            api = ", ".join(f"{method} {seconds * 1000:.0f}ms" for method, seconds in trace.api_calls)
+            print(f"Slow update ({elapsed * 1000:.0f}ms) {kind} {detail}; db: [{db}]; bot api: [{api}]")
+
+
+def timed_handler(callback, name):
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context, *args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+def instrument_handlers(app):
+    """
+    Wrap the callback of every handler registered on app with a timer.
+    """
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = timed_handler(handler.callback, getattr(handler.callback, "__name__", "handler"))
+
+
+def run_db_method(method, *args):
+    """
+    Run a DatabaseManager method on the executor thread, counting the statements it executes.
+    :return: (result, statements)
+    """
+    _thread.statements = 0
+    try:
+        return method(*args), _thread.statements
+    finally:
+        _thread.statements = None
+
+
+async def observe_db_call(name, call):
+    """
+    :param call: Awaitable resolving to run_db_method's (result, statements).
+    """
+    started = time.perf_counter()
+    result, statements = await call
+    elapsed = time.perf_counter() - started
+    db_method_seconds.observe(elapsed, name)
+    db_method_queries.inc(name, amount=statements)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.db_calls.append((name, elapsed, statements))
+    return result
+
+
+class InstrumentedCursor:
+    def __init__(self, cursor):
+        """
+        Times each statement run through a pg8000 cursor.
+        """
+        self._cursor = cursor
+
+    def execute(self, sql, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(sql, *args, **kwargs)
+        finally:
+            # The first keyword and table keep the label set small
+            statement = " ".join(sql.split()[:4])[:40]
+            db_query_seconds.observe(time.perf_counter() - started, statement)
+            if getattr(_thread, "statements", None) is not None:
+                _thread.statements += 1
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def observe_api_call(endpoint, seconds):
+    bot_api_seconds.observe(seconds, endpoint)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.api_calls.append((endpoint, seconds))
+
+
+async def _serve(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body = render().encode("utf-8")
+            status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, status, content_type = b"Not found\n", "404 Not Found", "text/plain"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(host=None, port=None):
+    """
+    Serve GET /metrics on METRICS_HOST:METRICS_PORT (default 127.0.0.1:9100).
+    """
+    host = host or os.getenv("METRICS_HOST", "127.0.0.1")
+    port = port or int(os.getenv("METRICS_PORT", "9100"))
+    return await asyncio.start_server(_serve, host, port)
@@ -0,0 +1,249 @@
+import json
+import sys
+from db_pool import ConnectionPool
+
+
+# Arbitrary key for pg_advisory_xact_lock so concurrently starting workers migrate one at a time
+MIGRATION_LOCK_ID = 7413001
+
+# (version, description, statements). Append only: never edit a migration that has shipped.
+MIGRATIONS = [
+    (1, "create decks and cards", [
+        """
+        CREATE TABLE IF NOT EXISTS decks (
+            id UUID PRIMARY KEY,
+            name TEXT NOT NULL,
+            user_id TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS cards (
+            id UUID PRIMARY KEY,
+            deck_id UUID NOT NULL,
+            user_id TEXT NOT NULL,
+            front TEXT NOT NULL,
+            back TEXT NOT NULL,
+            last_revised TIMESTAMP NOT NULL,
+            level INTEGER NOT NULL,
+            FOREIGN KEY(deck_id) REFERENCES decks(id) ON DELETE CASCADE
+        )
+        """,
+    ]),
+    (2, "unique deck name per user", [
+        "CREATE UNIQUE INDEX IF NOT EXISTS decks_user_id_name_key ON decks (user_id, name)",
+    ]),
+    # front/back stay out of the index: long card texts would overflow the btree tuple limit,
+    # and the heap lookup for at most six rows is cheap once the scan and sort are gone.
+    (3, "card selection index", [
+        """
+        CREATE INDEX IF NOT EXISTS cards_deck_level_revised_idx
+        ON cards (deck_id, level, last_revised) INCLUDE (id, user_id)
+        """,
+    ]),
+    # id breaks ties for keyset pagination; the old index is a strict prefix of the new one
+    (4, "card keyset pagination index", [
+        """
+        CREATE INDEX IF NOT EXISTS cards_deck_level_revised_id_idx
+        ON cards (deck_id, level, last_revised, id) INCLUDE (user_id)
+        """,
+        "DROP INDEX IF EXISTS cards_deck_level_revised_idx",
+    ]),
+    (5, "spilled session state", [
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            namespace TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (namespace, user_id)
+        )
+        """,
+    ]),
+    (6, "bulk import bookkeeping", [
+        """
+        CREATE TABLE IF NOT EXISTS import_files (
+            file_name TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            decks INTEGER NOT NULL,
+            cards INTEGER NOT NULL,
+            imported_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    (7, "spaced repetition scheduling state", [
+        """
+        ALTER TABLE cards
+            ADD COLUMN IF NOT EXISTS ease REAL NOT NULL DEFAULT 2.5,
+            ADD COLUMN IF NOT EXISTS interval_days REAL NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS due_at TIMESTAMP NOT NULL DEFAULT now()
+        """,
+        # Existing cards become due in the order they were last revised
+        "UPDATE cards SET due_at = last_revised",
+        """
+        CREATE INDEX IF NOT EXISTS cards_deck_due_idx
+        ON cards (deck_id, due_at, id) INCLUDE (user_id)
+        """,
+    ]),
+    (8, "review reminders", [
+        "CREATE INDEX IF NOT EXISTS cards_user_due_idx ON cards (user_id, due_at)",
+        """
+        CREATE TABLE IF NOT EXISTS reminder_settings (
+            user_id TEXT PRIMARY KEY,
+            enabled BOOLEAN NOT NULL DEFAULT TRUE,
+            last_sent_at TIMESTAMP
+        )
+        """,
+    ]),
+    # Serves both the ILIKE substring match and the <% fuzzy match of search_cards
+    (9, "card search index", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX IF NOT EXISTS cards_search_idx ON cards USING gin ((front || ' ' || back) gin_trgm_ops)",
+    ]),
+]
+
+# Queries on the hot path and sample parameters for EXPLAIN. Keep in sync with services_db.
+HOT_QUERIES = {
+    "get_deck": (
+        "SELECT id, name FROM decks WHERE name = %s AND user_id = %s",
+        lambda deck_id, user_id, name: (name, user_id)
+    ),
+    "get_all_decks": (
+        "SELECT id, name FROM decks WHERE user_id = %s",
+        lambda deck_id, user_id, name: (user_id,)
+    ),
+    "select_cards_for_learning": (
+        """
+        SELECT id, front, back, last_revised, level, ease, interval_days, due_at
+        FROM cards
+        WHERE deck_id = %s AND user_id = %s
+        ORDER BY due_at ASC, id ASC
+        LIMIT 6
+        """,
+        lambda deck_id, user_id, name: (deck_id, user_id)
+    ),
+    "select_cards_page": (
+        """
+        SELECT id, front, back, last_revised, level
+        FROM cards
+        WHERE deck_id = %s AND user_id = %s
+          AND (level, last_revised, id) > (%s, CAST(%s AS TIMESTAMP), CAST(%s AS UUID))
+        ORDER BY level ASC, last_revised ASC, id ASC
+        LIMIT 6
+        """,
+        lambda deck_id, user_id, name: (deck_id, user_id, 0, "1970-01-01T00:00:00", "00000000-0000-4000-8000-000000000000")
+    ),
+    "edit_card": (
+        """
+        UPDATE cards
+        SET level = %s, last_revised = CAST(%s AS TIMESTAMP)
+        FROM decks
+        WHERE cards.id = CAST(%s AS UUID) AND cards.user_id = %s
+          AND decks.id = cards.deck_id AND decks.name = %s AND decks.user_id = %s
+        """,
+        lambda deck_id, user_id, name: (0, "1970-01-01T00:00:00", "00000000-0000-4000-8000-000000000000", user_id, name, user_id)
+    ),
+}
+
+
+def ensure_migrations_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+    """)
+
+
+def applied_versions(cursor):
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(pool):
+    """
+    Apply pending migrations in one transaction.
+    :param pool: A db_pool.ConnectionPool.
+    :return: The list of versions applied by this call.
+    """
+    with pool.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        ensure_migrations_table(cursor)
+        applied = applied_versions(cursor)
+        newly_applied = []
+        for version, description, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            newly_applied.append(version)
+    return newly_applied
+
+
+def status(pool):
+    with pool.cursor() as cursor:
+        ensure_migrations_table(cursor)
+        applied = applied_versions(cursor)
+    return [(version, description, version in applied) for version, description, _ in MIGRATIONS]
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def check_query_plans(pool):
+    """
+    EXPLAIN every hot query and report those that still need a sequential scan or a sort.
+    Sequential scans and sorts are disabled for the check, so a small table that the planner
+    would rightly scan still passes while a missing index is reported.
+    :return: A dict of query name -> list of offending plan node types (empty when fine).
+    """
+    problems = {}
+    with pool.cursor() as cursor:
+        cursor.execute("SELECT id, user_id, name FROM decks LIMIT 1")
+        sample = cursor.fetchone() or ("00000000-0000-4000-8000-000000000000", "0", "")
+        deck_id, user_id, name = str(sample[0]), sample[1], sample[2]
+
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("SET LOCAL enable_sort = off")
+        for query_name, (sql, params) in HOT_QUERIES.items():
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params(deck_id, user_id, name))
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            nodes = [node["Node Type"] for node in _plan_nodes(plan[0]["Plan"])]
+            problems[query_name] = [node for node in nodes if node in ("Seq Scan", "Sort")]
+    return problems
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "migrate"
+    pool = ConnectionPool(min_size=0, max_size=1)
+    try:
+        if command == "migrate":
+            applied = migrate(pool)
+            print("Applied migrations: " + (", ".join(map(str, applied)) if applied else "none"))
+        elif command == "status":
+            for version, description, applied in status(pool):
+                print(f"{version:>4} {'applied' if applied else 'pending':<8} {description}")
+        elif command == "check":
+            problems = check_query_plans(pool)
+            for query_name, nodes in problems.items():
+                print(f"{query_name}: {'OK' if not nodes else 'uses ' + ', '.join(nodes)}")
+            return 1 if any(problems.values()) else 0
+        else:
+            print("Usage: python migrations.py [migrate|status|check]")
+            return 2
+    finally:
+        pool.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
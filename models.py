@@ -1,12 +1,16 @@
 from datetime import datetime
 
 class Card:
-    def __init__(self, front, back, id, last_revised=None, level=0):
+    def __init__(self, front, back, id, last_revised=None, level=0, ease=2.5, interval=0.0, due_at=None):
         self.front = front
         self.back = back
         self.id = id
         self.last_revised = last_revised or datetime.now().isoformat()
         self.level = level
+        # Scheduling state, see scheduler.py
+        self.ease = ease
+        self.interval = interval
+        self.due_at = due_at or self.last_revised
 
     def to_dict(self):
         return {
@@ -14,7 +18,10 @@ class Card:
             "back": self.back,
             "id": self.id,
             "last_revised": self.last_revised,
-            "level": self.level
+            "level": self.level,
+            "ease": self.ease,
+            "interval": self.interval,
+            "due_at": self.due_at
         }
 
     @classmethod
@@ -24,7 +31,10 @@ class Card:
             back=data["back"],
             id=data["id"],
             last_revised=data["last_revised"],
-            level=data["level"]
+            level=data["level"],
+            ease=data.get("ease", 2.5),
+            interval=data.get("interval", 0.0),
+            due_at=data.get("due_at")
         )
 
 
@@ -52,3 +62,27 @@ class Deck:
         deck = cls(data["name"], data["id"])
         deck.cards = [Card.from_dict(card) for card in data["cards"]]
         return deck
+
+
+class CardPage:
+    def __init__(self, cards, has_next, total, next_after=None):
+        """
+        One page of a deck's cards in (level, last_revised, id) order.
+        :param next_after: Keyset position to pass as `after` for the following page.
+        """
+        self.cards = cards
+        self.has_next = has_next
+        self.total = total
+        self.next_after = next_after
+
+
+class SearchPage:
+    def __init__(self, hits, has_next, offset=0):
+        """
+        One page of search results, best match first.
+        :param hits: List of (deck_name, Card).
+        :param offset: Position of the first hit in the full result list.
+        """
+        self.hits = hits
+        self.has_next = has_next
+        self.offset = offset
@@ -0,0 +1,272 @@
+from collections import deque
+from telegram.error import BadRequest, Forbidden, InvalidToken, NetworkError, RetryAfter, TimedOut
+from telegram.ext import BaseRateLimiter
+from api_calls import current_user
+from rate_limit import TokenBucket
+import asyncio
+import heapq
+import itertools
+import os
+import time
+
+
+# Lower runs first
+INTERACTIVE = 0
+BULK = 10
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class _Request:
+    __slots__ = ("priority", "chat_id", "callback", "args", "kwargs", "endpoint", "data", "futures", "enqueued", "user")
+
+    def __init__(self, priority, chat_id, callback, args, kwargs, endpoint, data):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.endpoint = endpoint
+        self.data = data
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.enqueued = time.monotonic()
+        self.user = current_user.get()
+
+    def _same_target(self, other, keys):
+        return {k: v for k, v in self.data.items() if k not in keys} == {
+            k: v for k, v in other.data.items() if k not in keys
+        }
+
+    def absorb(self, other):
+        """
+        Fold a later request for the same chat into this one if both can go out as one call:
+        consecutive plain texts become one message, and a newer edit of the same message
+        replaces a pending one.
+        :return: Whether other was absorbed.
+        """
+        if self.endpoint != other.endpoint:
+            return False
+        if self.endpoint == "sendMessage":
+            text = self.data["text"] + "\n\n" + other.data["text"]
+            # A keyboard belongs to its own message, so only the last text may carry one
+            if ("reply_markup" in self.data or len(text) > MAX_MESSAGE_LENGTH
+                    or not self._same_target(other, ("text", "reply_markup"))):
+                return False
+            self.data = dict(other.data, text=text)
+        elif self.endpoint == "editMessageText":
+            if not self._same_target(other, ("text", "reply_markup", "parse_mode", "entities")):
+                return False
+            self.data = other.data
+        else:
+            return False
+        self.args = (self.endpoint, self.data) + tuple(self.args[2:])
+        self.futures.extend(other.futures)
+        return True
+
+
+class OutboxRateLimiter(BaseRateLimiter):
+    def __init__(self, global_rate=None, chat_rate=None, chat_burst=None, group_rate=None,
+                 max_concurrency=None, max_retries=3, backoff=0.5):
+        """
+        Outbound layer for every Bot API call made through the application's bot.
+        Requests wait in per-chat queues and leave in priority order (interactive replies before bulk
+        jobs such as reminders), within a global and a per-chat token bucket. Each chat has at most one
+        request in flight, so a chat's messages keep their order. Texts queued back to back for the same
+        chat are merged and superseded edits of one message are dropped. Flood waits (429) are retried
+        after the time Telegram asks for, network errors with exponential backoff.
+        :param global_rate: Requests per second overall (OUTBOX_GLOBAL_RATE, default 30).
+        :param chat_rate: Requests per second into a private chat (OUTBOX_CHAT_RATE, default 1).
+        :param chat_burst: Requests a private chat may get at once (OUTBOX_CHAT_BURST, default 3).
+        :param group_rate: Requests per second into a group (OUTBOX_GROUP_RATE, default 20 per minute).
+        :param max_concurrency: Requests in flight at once (OUTBOX_CONCURRENCY, default 64).
+        """
+        self.global_bucket = TokenBucket(global_rate or float(os.getenv("OUTBOX_GLOBAL_RATE", "30")))
+        self.chat_rate = chat_rate or float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+        self.chat_burst = chat_burst or float(os.getenv("OUTBOX_CHAT_BURST", "3"))
+        self.group_rate = group_rate or float(os.getenv("OUTBOX_GROUP_RATE", str(20 / 60)))
+        self.max_concurrency = max_concurrency or int(os.getenv("OUTBOX_CONCURRENCY", "64"))
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._queues = {}  # chat_id -> deque of _Request
+        self._buckets = {}  # chat_id -> TokenBucket, dropped once the chat is idle and full
+        self._scheduled = set()  # chats in the heap, waiting for a token or with a request in flight
+        self._heap = []
+        self._sequence = itertools.count()
+        self._slots = None
+        self._wakeup = None
+        self._worker = None
+
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+        self.flood_waits = 0
+        self.failed = 0
+        self.in_flight = 0
+        self._latencies = deque(maxlen=1000)
+
+    async def initialize(self):
+        if self._worker is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for queue in self._queues.values():
+            for request in queue:
+                for future in request.futures:
+                    if not future.done():
+                        future.cancel()
+        self._queues.clear()
+        self._scheduled.clear()
+        self._heap.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        """
+        :param rate_limit_args: An explicit priority; otherwise updates from a user are INTERACTIVE
+                                and everything else (jobs) is BULK.
+        """
+        await self.initialize()
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        else:
+            # Updates are tagged with their user by PerUserUpdateProcessor; jobs are not
+            priority = INTERACTIVE if current_user.get() is not None else BULK
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # Callback answers, getMe and the like are not messages into a chat: no queue, no limits
+            return await self._call_now(callback, args, kwargs)
+        request = _Request(priority, chat_id, callback, args, kwargs, endpoint, data)
+        queue = self._queues.setdefault(chat_id, deque())
+        if queue and queue[-1].absorb(request):
+            self.merged += 1
+        else:
+            queue.append(request)
+        self._schedule(chat_id)
+        return await request.futures[0]
+
+    async def _call_now(self, callback, args, kwargs):
+        request = _Request(INTERACTIVE, None, callback, args, kwargs, None, {})
+        try:
+            result = await self._call(request)
+        except Exception:
+            self.failed += 1
+            raise
+        self.sent += 1
+        self._latencies.append(time.monotonic() - request.enqueued)
+        return result
+
+    def _schedule(self, chat_id, force=False):
+        if chat_id in self._scheduled and not force:
+            return
+        queue = self._queues.get(chat_id)
+        if not queue:
+            self._scheduled.discard(chat_id)
+            self._queues.pop(chat_id, None)
+            return
+        self._scheduled.add(chat_id)
+        heapq.heappush(self._heap, (queue[0].priority, next(self._sequence), chat_id))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Groups and channels have negative ids or an @username
+            if str(chat_id).startswith(("-", "@")):
+                bucket = TokenBucket(self.group_rate, capacity=1)
+            else:
+                bucket = TokenBucket(self.chat_rate, capacity=self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _, _, chat_id = heapq.heappop(self._heap)
+            delay = self._chat_bucket(chat_id).delay()
+            if delay:
+                # Come back to this chat once its bucket has a token; other chats go meanwhile
+                asyncio.get_running_loop().call_later(delay, self._schedule, chat_id, True)
+                continue
+            await self.global_bucket.acquire()
+            await self._slots.acquire()
+            request = self._queues[chat_id].popleft()
+            asyncio.create_task(self._send(request))
+
+    async def _send(self, request):
+        # Sent from the worker's task: keep the call attributed to the user it was made for
+        current_user.set(request.user)
+        self.in_flight += 1
+        try:
+            result = await self._call(request)
+        except Exception as e:
+            self.failed += 1
+            for future in request.futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            self.sent += 1
+            for future in request.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            self._latencies.append(time.monotonic() - request.enqueued)
+            # The chat's next request may go now that this one is done
+            self._scheduled.discard(request.chat_id)
+            self._schedule(request.chat_id)
+            self._forget_idle_bucket(request.chat_id)
+
+    def _forget_idle_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is not None and chat_id not in self._scheduled:
+            bucket._refill()
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[chat_id]
+
+    async def _call(self, request):
+        for attempt in itertools.count():
+            try:
+                return await request.callback(*request.args, **request.kwargs)
+            except RetryAfter as e:
+                self.flood_waits += 1
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(e.retry_after)
+            except TimedOut:
+                # The request may have gone through; sending it again could duplicate a message
+                raise
+            except (BadRequest, Forbidden, InvalidToken):
+                # Permanent: BadRequest subclasses NetworkError, but sending it again fails the same way
+                raise
+            except NetworkError:
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            self.retries += 1
+
+    def stats(self):
+        """
+        Queue depth, counters and the latency (enqueue to response, seconds) of the last 1000 requests.
+        """
+        latencies = sorted(self._latencies)
+        return {
+            "queue_depth": sum(len(queue) for queue in self._queues.values()),
+            "chats_waiting": len(self._scheduled),
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "merged": self.merged,
+            "retries": self.retries,
+            "flood_waits": self.flood_waits,
+            "failed": self.failed,
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
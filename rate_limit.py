@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import asyncio
+import os
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: Tokens added per second.
+        :param capacity: Largest burst; defaults to one second's worth of tokens.
+        """
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """
+        Take a token if one is available.
+        :return: 0 when a token was taken, otherwise the seconds until one will be.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            delay = self.delay()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+
+class SendLimiter:
+    def __init__(self, global_rate=None, per_chat_rate=None, max_chats=10000):
+        """
+        Keep sends under Telegram's limits: about 30 messages per second overall and one per
+        second in any single chat.
+        :param global_rate: Messages per second across all chats (SEND_RATE_GLOBAL, default 30).
+        :param per_chat_rate: Messages per second into one chat (SEND_RATE_PER_CHAT, default 1).
+        :param max_chats: Per-chat buckets kept; the least recently used are dropped.
+        """
+        self.global_bucket = TokenBucket(global_rate or float(os.getenv("SEND_RATE_GLOBAL", "30")))
+        self.per_chat_rate = per_chat_rate or float(os.getenv("SEND_RATE_PER_CHAT", "1"))
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, capacity=1)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def acquire(self, chat_id):
+        """
+        Wait until a message may be sent to chat_id.
+        """
+        await self._chat_bucket(chat_id).acquire()
+        # One waiter at a time on the global bucket keeps sends in arrival order
+        async with self._lock:
+            await self.global_bucket.acquire()
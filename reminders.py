@@ -0,0 +1,83 @@
+from datetime import datetime, time as dt_time, timedelta, timezone
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from rate_limit import SendLimiter
+import asyncio
+import os
+import time
+
+
+class ReviewReminders:
+    def __init__(self, db, limiter=None, shards=None, batch_size=None, window=None, at=None):
+        """
+        Daily "you have N cards due" messages.
+        Users are split into shards by a hash of their id. Each daily round starts one job per shard,
+        spread evenly over `window` seconds; a shard walks its users in batches, one aggregate due-count
+        query per batch, and sends through a token bucket kept below Telegram's global limit so
+        interactive replies still get through.
+        :param db: An AsyncDatabaseManager.
+        :param limiter: A rate_limit.SendLimiter; by default REMINDER_RATE (20) messages per second.
+        :param shards: REMINDER_SHARDS, default 16.
+        :param batch_size: Users per due-count query, REMINDER_BATCH_SIZE, default 1000.
+        :param window: Seconds over which shard starts are spread, REMINDER_WINDOW, default 3600.
+        :param at: UTC time of day of the round, REMINDER_TIME "HH:MM", default "09:00".
+        """
+        self.db = db
+        self.limiter = limiter or SendLimiter(global_rate=float(os.getenv("REMINDER_RATE", "20")))
+        self.shards = shards or int(os.getenv("REMINDER_SHARDS", "16"))
+        self.batch_size = batch_size or int(os.getenv("REMINDER_BATCH_SIZE", "1000"))
+        self.window = window if window is not None else float(os.getenv("REMINDER_WINDOW", "3600"))
+        if at is None:
+            hour, minute = os.getenv("REMINDER_TIME", "09:00").split(":")
+            at = dt_time(int(hour), int(minute), tzinfo=timezone.utc)
+        self.at = at
+
+    def schedule(self, job_queue):
+        job_queue.run_daily(self.start_round, time=self.at, name="reminders")
+
+    async def start_round(self, context):
+        spacing = self.window / self.shards
+        for shard in range(self.shards):
+            context.job_queue.run_once(self.run_shard, when=shard * spacing, data=shard, name=f"reminders-{shard}")
+
+    async def run_shard(self, context):
+        shard = context.job.data
+        started = time.monotonic()
+        now = datetime.now()
+        # Anyone reminded in the last 20 hours already got today's message, e.g. before a restart
+        not_reminded_since = now - timedelta(hours=20)
+        after = ""
+        sent_total = 0
+        while True:
+            rows = await self.db.due_counts(shard, self.shards, now, not_reminded_since, after, self.batch_size)
+            sent = []
+            for user_id, due in rows:
+                if await self.send(context.bot, user_id, due):
+                    sent.append(user_id)
+            await self.db.mark_reminded(sent, now)
+            sent_total += len(sent)
+            if len(rows) < self.batch_size:
+                break
+            after = rows[-1][0]
+        print(f"Reminder shard {shard}/{self.shards}: {sent_total} sent in {time.monotonic() - started:.1f}s")
+
+    async def send(self, bot, user_id, due):
+        """
+        :return: Whether the reminder was delivered.
+        """
+        text = (f"You have {due} card{'s' if due != 1 else ''} due for review. Send /menu to start learning.\n"
+                f"Turn these messages off with /reminders off")
+        for attempt in range(2):
+            await self.limiter.acquire(user_id)
+            try:
+                await bot.send_message(chat_id=int(user_id), text=text)
+                return True
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                # Blocked the bot or deleted the account
+                await self.db.set_reminders(user_id, False)
+                return False
+            except TelegramError as e:
+                print(f"Reminder to {user_id} failed: {e}")
+                return False
+        return False
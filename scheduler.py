@@ -0,0 +1,166 @@
+from datetime import datetime, timedelta
+import math
+import os
+import sys
+
+
+# Review grades, shared by every scheduler
+AGAIN = 1
+HARD = 2
+GOOD = 3
+EASY = 4
+
+# Retry a failed card within the same day
+RELEARN_INTERVAL = 10 / (24 * 60)
+
+
+def grade_session(correct, incorrect):
+    """
+    Turn a learning session's answer counts for one card into a review grade.
+    """
+    if incorrect == 0 and correct > 0:
+        return EASY
+    if incorrect <= 1:
+        return GOOD
+    if incorrect <= 2:
+        return HARD
+    return AGAIN
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+class SM2Scheduler:
+    name = "sm2"
+
+    def __init__(self, interval_modifier=None, min_ease=1.3):
+        """
+        SuperMemo-2. card.ease is the ease factor, card.interval the interval in days.
+        :param interval_modifier: Scales every interval (SM2_INTERVAL_MODIFIER, default 1.0).
+        """
+        self.interval_modifier = interval_modifier or float(os.getenv("SM2_INTERVAL_MODIFIER", "1.0"))
+        self.min_ease = min_ease
+
+    def due_in(self, interval):
+        return interval * self.interval_modifier
+
+    def reschedule(self, last_revised, interval, due_at):
+        # The relearn step is stored as the interval too, so every card goes through due_in
+        return _parse_time(last_revised) + timedelta(days=self.due_in(interval))
+
+    def review(self, card, grade, now=None):
+        now = now or datetime.now()
+        quality = grade + 1  # SM-2 quality 2..5
+        if grade == AGAIN:
+            card.interval = RELEARN_INTERVAL
+        elif card.interval < 1:
+            card.interval = 1.0
+        elif card.interval < 6:
+            card.interval = 6.0
+        else:
+            card.interval = card.interval * card.ease
+        card.ease = max(self.min_ease, card.ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+        card.last_revised = now
+        card.due_at = now + timedelta(days=self.due_in(card.interval))
+        return card
+
+
+class FSRSScheduler:
+    name = "fsrs"
+
+    # FSRS v4 default weights
+    WEIGHTS = [0.4, 0.6, 2.4, 5.8, 4.93, 0.94, 0.86, 0.01, 1.49, 0.14, 0.94, 2.18, 0.05, 0.34, 1.26, 0.29, 2.61]
+
+    def __init__(self, retention=None, weights=None):
+        """
+        FSRS-style memory model. card.ease holds the difficulty (1-10), card.interval the
+        stability in days, i.e. the interval at which recall probability falls to 90%.
+        :param retention: Target recall probability at review time (FSRS_RETENTION, default 0.9).
+        """
+        self.retention = retention or float(os.getenv("FSRS_RETENTION", "0.9"))
+        self.w = weights or self.WEIGHTS
+
+    def due_in(self, stability):
+        return stability * 9 * (1 / self.retention - 1)
+
+    def reschedule(self, last_revised, stability, due_at):
+        # A lapsed card is due after the relearn step whatever its stability; keep that date
+        last_revised = _parse_time(last_revised)
+        if due_at is not None and _parse_time(due_at) - last_revised <= timedelta(days=RELEARN_INTERVAL):
+            return _parse_time(due_at)
+        return last_revised + timedelta(days=self.due_in(stability))
+
+    def _initial_difficulty(self, grade):
+        return min(10.0, max(1.0, self.w[4] - (grade - 3) * self.w[5]))
+
+    def review(self, card, grade, now=None):
+        now = now or datetime.now()
+        w = self.w
+        if card.interval <= 0:
+            # First review
+            difficulty = self._initial_difficulty(grade)
+            stability = w[grade - 1]
+        else:
+            difficulty = min(10.0, max(1.0, card.ease))
+            stability = card.interval
+            elapsed = max(0.0, (now - _parse_time(card.last_revised)).total_seconds() / 86400)
+            retrievability = (1 + elapsed / (9 * stability)) ** -1
+            if grade == AGAIN:
+                stability = (w[11] * difficulty ** -w[12] * ((stability + 1) ** w[13] - 1)
+                             * math.exp(w[14] * (1 - retrievability)))
+            else:
+                stability = stability * (1 + math.exp(w[8]) * (11 - difficulty) * stability ** -w[9]
+                                         * (math.exp(w[10] * (1 - retrievability)) - 1)
+                                         * (w[15] if grade == HARD else 1) * (w[16] if grade == EASY else 1))
+            difficulty = difficulty - w[6] * (grade - 3)
+            difficulty = min(10.0, max(1.0, w[7] * self._initial_difficulty(GOOD) + (1 - w[7]) * difficulty))
+        card.ease = difficulty
+        card.interval = stability
+        card.last_revised = now
+        card.due_at = now + timedelta(days=RELEARN_INTERVAL if grade == AGAIN else self.due_in(stability))
+        return card
+
+
+SCHEDULERS = {SM2Scheduler.name: SM2Scheduler, FSRSScheduler.name: FSRSScheduler}
+
+
+def create_scheduler(name=None):
+    """
+    Build the scheduler named by SCHEDULER ("sm2" or "fsrs", default "sm2").
+    """
+    name = name or os.getenv("SCHEDULER", SM2Scheduler.name)
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown SCHEDULER '{name}'")
+    return SCHEDULERS[name]()
+
+
+def reschedule_batch(scheduler, last_revised, intervals, due_at):
+    """
+    Recompute due dates column-wise for a batch of cards after scheduler parameters changed.
+    :param last_revised: Column of last review times.
+    :param intervals: Column of stored intervals (days, or stability for FSRS).
+    :param due_at: Column of current due dates.
+    :return: Column of new due_at values.
+    """
+    reschedule = scheduler.reschedule
+    return [reschedule(*card) for card in zip(last_revised, intervals, due_at)]
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] != "reschedule":
+        print("Usage: python scheduler.py reschedule [sm2|fsrs]")
+        return 2
+    from services_db import DatabaseManager
+    scheduler = create_scheduler(argv[2] if len(argv) > 2 else None)
+    manager = DatabaseManager()
+    try:
+        updated = manager.reschedule_all(scheduler)
+    finally:
+        manager.close_connection()
+    print(f"Rescheduled {updated} cards with {scheduler.name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,110 @@
+from collections import defaultdict
+import os
+import re
+
+
+# Minimum share of the query's trigrams a card must contain to match fuzzily, like pg_trgm's
+# word_similarity_threshold
+THRESHOLD = float(os.getenv("SEARCH_THRESHOLD", "0.5"))
+
+_WORD = re.compile(r"\w+")
+
+
+def trigrams(text):
+    """
+    Trigrams of every word, padded as pg_trgm does: two spaces in front, one behind.
+    """
+    grams = set()
+    for word in _WORD.findall(text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def inner_trigrams(text):
+    """
+    Unpadded trigrams of every word; a text containing `text` as a substring contains all of them.
+    """
+    grams = set()
+    for word in _WORD.findall(text.lower()):
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def like_pattern(query):
+    """
+    A LIKE pattern matching query anywhere, with backslash as the escape character.
+    """
+    return "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+class TrigramIndex:
+    def __init__(self, threshold=None):
+        """
+        In-memory inverted index from trigrams to documents for substring and typo-tolerant search.
+        Substring matches rank first, then documents by the share of the query's trigrams they contain.
+        """
+        self.threshold = threshold or THRESHOLD
+        self._postings = defaultdict(set)  # trigram -> doc ids
+        self._documents = {}  # doc id -> (lowercase text, trigrams)
+
+    def add(self, doc_id, text):
+        if doc_id in self._documents:
+            self.remove(doc_id)
+        grams = frozenset(trigrams(text))
+        self._documents[doc_id] = (text.lower(), grams)
+        for gram in grams:
+            self._postings[gram].add(doc_id)
+
+    def remove(self, doc_id):
+        document = self._documents.pop(doc_id, None)
+        if document is None:
+            return
+        for gram in document[1]:
+            posting = self._postings[gram]
+            posting.discard(doc_id)
+            if not posting:
+                del self._postings[gram]
+
+    def __len__(self):
+        return len(self._documents)
+
+    def search(self, query):
+        """
+        :return: List of (doc id, score) best first; score is 1.0 plus the similarity for substring matches.
+        """
+        needle = query.lower().strip()
+        query_grams = trigrams(needle)
+        if not needle or not query_grams:
+            return []
+        postings = self._postings
+        # A fuzzy match shares at least `required` trigrams with the query, so it must contain one of
+        # the len - required + 1 rarest ones: only their postings need scoring
+        required = max(1, -int(-self.threshold * len(query_grams) // 1))
+        rarest = sorted(query_grams, key=lambda gram: len(postings.get(gram, ())))
+        candidates = set()
+        for gram in rarest[:len(rarest) - required + 1]:
+            candidates.update(postings.get(gram, ()))
+        # Substring matches contain every inner trigram; intersect from the rarest
+        inner = sorted(inner_trigrams(needle), key=lambda gram: len(postings.get(gram, ())))
+        if inner:
+            substring = set(postings.get(inner[0], ()))
+            for gram in inner[1:]:
+                substring.intersection_update(postings.get(gram, ()))
+                if not substring:
+                    break
+            candidates.update(substring)
+        else:
+            # Too short for inner trigrams: words starting with the query
+            word = _WORD.findall(needle)[0]
+            candidates.update(postings.get(f"  {word}"[-3:], ()))
+        results = []
+        for doc_id in candidates:
+            text, grams = self._documents[doc_id]
+            score = len(query_grams & grams) / len(query_grams)
+            if needle in text:
+                results.append((doc_id, 1.0 + score))
+            elif score >= self.threshold:
+                results.append((doc_id, score))
+        results.sort(key=lambda result: -result[1])
+        return results
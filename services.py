@@ -1,76 +1,340 @@
 import json
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from models import Deck, Card
+from models import Deck, Card, CardPage, SearchPage
+from search import TrigramIndex
+from storage import StorageBackend, timestamp
+import threading
 import uuid
-import random
-import time
+import zlib
+import os
+
+# Compact once the journal outgrows both this many bytes and the snapshot
+COMPACT_BYTES = int(os.getenv("JSON_COMPACT_BYTES", str(256 * 1024)))
+
 
 class DatabaseManager:
-    def __init__(self, userId):
-        self.decks = self.load_decks(userId)
+    def __init__(self, userId, data_dir=""):
+        """
+        One user's decks, stored as a snapshot (<userId>.json, the same array format as always) plus an
+        append-only journal (<userId>.journal) of the mutations made since. Every mutation is a single
+        fsync'd append of one JSON line; the snapshot is rewritten only by compaction, which runs on a
+        background thread once the journal is large, and on close().
+        Journal entries address decks and cards by id and are idempotent, so replaying a journal over a
+        snapshot that already contains it (after a crash during compaction) is harmless.
+        """
+        self.userId = str(userId)
+        self.data_dir = data_dir
+        self._lock = threading.RLock()
+        self._journal = None
+        self._journal_bytes = 0
+        self._snapshot_bytes = 0
+        self._compacting = None
+        self.decks = []
+        self._decks_by_name = {}
+        self._decks_by_id = {}
+        self._cards_by_id = {}
+        self._card_decks = {}  # card id -> deck id
+        self._search_index = None  # built on the first search
+        self.file_operations = 0  # loads, journal appends and snapshot writes, for benchmarks
+        self.load_decks(userId)
+
+    def _path(self, userId, suffix=".json"):
+        return os.path.join(self.data_dir, str(userId) + suffix)
 
     def load_decks(self, userId):
+        with self._lock:
+            try:
+                with open(self._path(userId), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                    self._snapshot_bytes = f.tell()
+            except FileNotFoundError:
+                data = []
+            for deck in data:
+                self._add_deck(Deck.from_dict(deck))
+            rotated = self._replay(self._path(userId, ".journal.old"))
+            self._journal_bytes = self._replay(self._path(userId, ".journal"))
+            self.file_operations += 1
+            if rotated:
+                # A compaction was interrupted; finish it before accepting writes
+                self.save_decks(userId)
+            return self.decks
+
+    def _replay(self, path):
+        """
+        Apply a journal's entries. A torn last line (a crash mid-append) is cut off.
+        :return: The journal's size in bytes, 0 when it does not exist.
+        """
         try:
-            with open(str(userId) + ".json", "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return [Deck.from_dict(deck) for deck in data]
+            f = open(path, "rb")
         except FileNotFoundError:
-            return []
+            return 0
+        good = 0
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(entry)
+                good += len(line)
+            size = f.seek(0, os.SEEK_END)
+        if good < size:
+            print(f"Truncating {size - good} unreadable bytes from {path}")
+            with open(path, "r+b") as f:
+                f.truncate(good)
+        return good
+
+    def _append(self, entries):
+        """
+        Durably journal entries with one write and one fsync, then apply them.
+        """
+        data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries).encode("utf-8")
+        if self._journal is None:
+            self._journal = os.open(self._path(self.userId, ".journal"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._journal, data)
+        os.fsync(self._journal)
+        self.file_operations += 1
+        self._journal_bytes += len(data)
+        for entry in entries:
+            self._apply(entry)
+        if self._journal_bytes > max(COMPACT_BYTES, self._snapshot_bytes) and self._compacting is None:
+            self.compact()
+
+    def _apply(self, entry):
+        op = entry["op"]
+        if op == "add_deck":
+            if entry["id"] not in self._decks_by_id:
+                self._add_deck(Deck(entry["name"], entry["id"]))
+        elif op == "delete_deck":
+            deck = self._decks_by_id.pop(entry["id"], None)
+            if deck:
+                self.decks.remove(deck)
+                del self._decks_by_name[deck.name]
+                for card in deck.cards:
+                    self._forget_card(card)
+        elif op == "add_card":
+            deck = self._decks_by_id.get(entry["deck"])
+            if deck and entry["card"]["id"] not in self._cards_by_id:
+                card = Card.from_dict(entry["card"])
+                deck.add_card(card)
+                self._index_card(deck, card)
+        elif op == "delete_card":
+            card = self._cards_by_id.get(entry["id"])
+            deck = self._decks_by_id.get(entry["deck"])
+            if card and deck:
+                self._forget_card(card)
+                deck.remove_card(card.id)
+        elif op == "update_card":
+            card = self._cards_by_id.get(entry["card"]["id"])
+            if card:
+                card.__dict__.update(Card.from_dict(entry["card"]).__dict__)
+                if self._search_index is not None:
+                    self._search_index.add(card.id, card.front + " " + card.back)
+
+    def _add_deck(self, deck):
+        self.decks.append(deck)
+        self._decks_by_name[deck.name] = deck
+        self._decks_by_id[deck.id] = deck
+        for card in deck.cards:
+            self._index_card(deck, card)
+
+    def _index_card(self, deck, card):
+        self._cards_by_id[card.id] = card
+        self._card_decks[card.id] = deck.id
+        if self._search_index is not None:
+            self._search_index.add(card.id, card.front + " " + card.back)
+
+    def _forget_card(self, card):
+        self._cards_by_id.pop(card.id, None)
+        self._card_decks.pop(card.id, None)
+        if self._search_index is not None:
+            self._search_index.remove(card.id)
 
     def save_decks(self, userId):
-        with open(str(userId) + ".json", "w", encoding="utf-8") as f:
-            json.dump([deck.to_dict() for deck in self.decks], f, ensure_ascii=False, indent=4)
+        """
+        Compact synchronously: write the snapshot atomically and drop the journal.
+        """
+        with self._lock:
+            self._wait_for_compaction()
+            self._close_journal()
+            self._write_snapshot([deck.to_dict() for deck in self.decks])
+            for suffix in (".journal", ".journal.old"):
+                try:
+                    os.remove(self._path(self.userId, suffix))
+                except FileNotFoundError:
+                    pass
+            self._journal_bytes = 0
+
+    def compact(self):
+        """
+        Start a background compaction: the journal is set aside and a fresh one started under the lock,
+        the snapshot of the state at that moment is written off the lock.
+        """
+        with self._lock:
+            if self._compacting is not None:
+                return
+            data = [deck.to_dict() for deck in self.decks]
+            self._close_journal()
+            journal, rotated = self._path(self.userId, ".journal"), self._path(self.userId, ".journal.old")
+            if os.path.exists(rotated):
+                # An earlier compaction failed and its journal holds mutations no snapshot has yet:
+                # keep them, followed by the newer ones
+                self._append_file(journal, rotated)
+            else:
+                os.replace(journal, rotated)
+            self._journal_bytes = 0
+            self._compacting = threading.Thread(target=self._finish_compaction, args=(data,), daemon=True)
+            self._compacting.start()
+
+    def _append_file(self, source, target):
+        with open(source, "rb") as f:
+            data = f.read()
+        fd = os.open(target, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.remove(source)
+        self.file_operations += 1
+
+    def _finish_compaction(self, data):
+        try:
+            self._write_snapshot(data)
+            os.remove(self._path(self.userId, ".journal.old"))
+        except OSError as e:
+            # The rotated journal stays and is replayed (then compacted) on the next load
+            print(f"Compaction of {self.userId} failed: {e}")
+        finally:
+            with self._lock:
+                self._compacting = None
+
+    def _wait_for_compaction(self):
+        thread = self._compacting
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _write_snapshot(self, data):
+        path = self._path(self.userId)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp, path)
+        self._snapshot_bytes = size
+        self.file_operations += 1
+
+    def _close_journal(self):
+        if self._journal is not None:
+            os.close(self._journal)
+            self._journal = None
+
+    def close(self):
+        """
+        Wait for a running compaction and fold any remaining journal into the snapshot.
+        """
+        self._wait_for_compaction()
+        with self._lock:
+            if self._journal_bytes:
+                self.save_decks(self.userId)
+            self._close_journal()
 
     def get_deck(self, name):
-        for deck in self.decks:
-            if deck.name == name:
-                return deck
-        return None
+        return self._decks_by_name.get(name)
+
+    def get_deck_by_id(self, deck_id):
+        return self._decks_by_id.get(deck_id)
 
     def generate_uuid4(self):
-        rnd = (random.Random())
-        rnd.seed(time.time() * 1000)
-        return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+        # Seeding from the clock gave two ids created in the same millisecond the same value
+        return str(uuid.uuid4())
 
 
     def add_deck(self, name, userId):
-        if self.get_deck(name):
-            return False
-        self.decks.append(Deck(name, self.generate_uuid4()))
-        self.save_decks(userId)
-        return True
+        with self._lock:
+            if self.get_deck(name):
+                return False
+            self._append([{"op": "add_deck", "id": self.generate_uuid4(), "name": name}])
+            return True
 
     def delete_deck(self, name, userId):
-        self.decks = [deck for deck in self.decks if deck.name != name]
-        self.save_decks(userId)
+        with self._lock:
+            deck = self.get_deck(name)
+            if deck:
+                self._append([{"op": "delete_deck", "id": deck.id}])
 
     # Card Management
     def add_card(self, deck_name, front, back, userId):
-        deck = self.get_deck(deck_name)
-        if deck:
-            deck.add_card(Card(front, back, self.generate_uuid4()))
-            self.save_decks(userId)
-            return True
-        return False
+        return self.add_cards(deck_name, [Card(front, back, self.generate_uuid4())], userId)
+
+    def add_cards(self, deck_name, cards, userId):
+        """
+        Journal many new cards with a single fsync.
+        """
+        with self._lock:
+            deck = self.get_deck(deck_name)
+            if deck:
+                if cards:
+                    self._append([{"op": "add_card", "deck": deck.id, "card": card.to_dict()} for card in cards])
+                return True
+            return False
 
     def delete_card(self, deck_name, id, userId):
-        deck = self.get_deck(deck_name)
-        if deck:
-            deck.remove_card(id)
-            self.save_decks(userId)
-            return True
-        return False
+        with self._lock:
+            deck = self.get_deck(deck_name)
+            if deck and self._card_decks.get(id) == deck.id:
+                self._append([{"op": "delete_card", "deck": deck.id, "id": id}])
+                return True
+            return False
 
-    def edit_card(self, deck_name, old_front, old_back, level, userId):
-        deck = self.get_deck(deck_name)
-        if deck:
-            for card in deck.cards:
-                if card.front == old_front and card.back == old_back:
-                    card.level = level
-                    card.last_revised = datetime.now().isoformat()
-                    self.save_decks(userId)
-                    return True
-        return False
+    def edit_card(self, deck_name, id, level, userId):
+        with self._lock:
+            deck = self.get_deck(deck_name)
+            if deck and self._card_decks.get(id) == deck.id:
+                edited = Card.from_dict(self._cards_by_id[id].to_dict())
+                edited.level = level
+                edited.last_revised = datetime.now().isoformat()
+                self._append([{"op": "update_card", "deck": deck.id, "card": edited.to_dict()}])
+                return True
+            return False
+
+    def update_cards(self, deck_name, cards, userId):
+        """
+        Journal the new state of existing cards of a deck with a single fsync.
+        :return: The number of cards updated.
+        """
+        with self._lock:
+            deck = self.get_deck(deck_name)
+            if not deck:
+                return 0
+            entries = [
+                {"op": "update_card", "deck": deck.id, "card": card.to_dict()}
+                for card in cards if card.id in self._cards_by_id
+            ]
+            if entries:
+                self._append(entries)
+            return len(entries)
+
+    def search(self, query):
+        """
+        Cards matching query on front or back, see search.TrigramIndex.
+        :return: List of (deck, card), best match first.
+        """
+        with self._lock:
+            if self._search_index is None:
+                self._search_index = TrigramIndex()
+                for card_id, card in self._cards_by_id.items():
+                    self._search_index.add(card_id, card.front + " " + card.back)
+            hits = [
+                (score, self._decks_by_id[self._card_decks[card_id]], self._cards_by_id[card_id])
+                for card_id, score in self._search_index.search(query)
+            ]
+        hits.sort(key=lambda hit: (-hit[0], hit[1].name, hit[2].id))
+        return [(deck, card) for _, deck, card in hits]
 
     # Learning Logic
     def select_cards_for_learning(self, deck_name):
@@ -96,3 +360,278 @@ class DatabaseManager:
             # Select up to six cards
             return cards
         return []
+
+class _OpenUser:
+    __slots__ = ("manager", "lock", "holders")
+
+    def __init__(self):
+        self.manager = None
+        self.lock = threading.RLock()
+        self.holders = 0  # threads using or waiting for the manager
+
+
+class JsonStorage(StorageBackend):
+    REMINDERS_FILE = "_reminders.json"
+
+    def __init__(self, data_dir=None, max_users=None):
+        """
+        StorageBackend over the original one-file-per-user JSON store, for running without a database.
+        Each user's DatabaseManager is loaded on first use and guarded by its own lock; beyond max_users
+        the least recently used idle ones are closed, folding their journal into the snapshot.
+        :param data_dir: Directory of the <user_id>.json files (JSON_DATA_DIR, default the working directory).
+        :param max_users: Users kept loaded, each with its decks and open journal (JSON_OPEN_USERS).
+        """
+        self.data_dir = data_dir if data_dir is not None else os.getenv("JSON_DATA_DIR", "")
+        if self.data_dir:
+            os.makedirs(self.data_dir, exist_ok=True)
+        self.max_users = max_users or int(os.getenv("JSON_OPEN_USERS", "1000"))
+        self._users = OrderedDict()  # user_id -> _OpenUser, least recently used first
+        self._lock = threading.Lock()
+        self._file_operations = 0  # of closed users and the reminders file
+        self._reminders = self._load_reminders()
+
+    @contextmanager
+    def _user(self, user_id):
+        """
+        The user's DatabaseManager, used under the user's lock.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = _OpenUser()
+            entry.holders += 1
+            self._users.move_to_end(user_id)
+        try:
+            with entry.lock:
+                if entry.manager is None:
+                    entry.manager = DatabaseManager(user_id, self.data_dir)
+                yield entry.manager
+        finally:
+            with self._lock:
+                entry.holders -= 1
+                overflow = len(self._users) - self.max_users
+            if overflow > 0:
+                self._close_idle(overflow)
+
+    def _close_idle(self, count):
+        for _ in range(count):
+            with self._lock:
+                user_id, entry = next(
+                    ((user_id, entry) for user_id, entry in self._users.items() if entry.holders == 0), (None, None)
+                )
+                if entry is None:
+                    return
+                # Held while closing, so nobody loads the user's files half written
+                entry.holders += 1
+            with entry.lock:
+                manager, entry.manager = entry.manager, None
+                if manager is not None:
+                    manager.close()
+            with self._lock:
+                if manager is not None:
+                    self._file_operations += manager.file_operations
+                entry.holders -= 1
+                if entry.holders == 0 and entry.manager is None and self._users.get(user_id) is entry:
+                    del self._users[user_id]
+
+    @property
+    def statements(self):
+        """
+        File operations so far, counted where the SQL backends count statements, for benchmarks.
+        """
+        with self._lock:
+            return self._file_operations + sum(
+                entry.manager.file_operations for entry in self._users.values() if entry.manager is not None
+            )
+
+    def _load_reminders(self):
+        try:
+            with open(os.path.join(self.data_dir, self.REMINDERS_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_reminders(self):
+        with open(os.path.join(self.data_dir, self.REMINDERS_FILE), "w", encoding="utf-8") as f:
+            json.dump(self._reminders, f, ensure_ascii=False)
+        self._file_operations += 1
+
+    # Deck Management
+    def add_deck(self, name, user_id):
+        with self._user(user_id) as manager:
+            return manager.add_deck(name, user_id)
+
+    def get_deck(self, name, user_id):
+        with self._user(user_id) as manager:
+            deck = manager.get_deck(name)
+            return Deck(deck.name, deck.id) if deck else None
+
+    def get_deck_by_id(self, deck_id, user_id):
+        with self._user(user_id) as manager:
+            deck = manager.get_deck_by_id(deck_id)
+            return Deck(deck.name, deck.id) if deck else None
+
+    def delete_deck(self, name, user_id):
+        with self._user(user_id) as manager:
+            manager.delete_deck(name, user_id)
+
+    def get_all_decks(self, user_id):
+        with self._user(user_id) as manager:
+            return sorted((Deck(deck.name, deck.id) for deck in manager.decks), key=lambda deck: deck.name)
+
+    # Card Management
+    def add_card(self, deck_name, front, back, user_id):
+        with self._user(user_id) as manager:
+            return manager.add_card(deck_name, front, back, user_id)
+
+    def delete_card(self, deck_name, card_id, user_id):
+        with self._user(user_id) as manager:
+            return manager.delete_card(deck_name, card_id, user_id)
+
+    def edit_card(self, deck_name, card_id, level, user_id):
+        with self._user(user_id) as manager:
+            return manager.edit_card(deck_name, card_id, level, user_id)
+
+    def import_cards(self, deck_name, rows, user_id, batch_size=1000, progress=None):
+        with self._user(user_id) as manager:
+            deck = manager.get_deck(deck_name)
+            if not deck:
+                return None
+            seen = {(card.front, card.back) for card in deck.cards}
+            duplicates = processed = 0
+            # Journaled in one append once the whole file is read, so a bad row adds nothing,
+            # like the single transaction of the database backends
+            cards = []
+            for front, back in rows:
+                processed += 1
+                if (front, back) in seen:
+                    duplicates += 1
+                    continue
+                seen.add((front, back))
+                cards.append(Card(front, back, str(uuid.uuid4())))
+                if progress and len(cards) % batch_size == 0:
+                    progress(processed, len(cards))
+            manager.add_cards(deck_name, cards, user_id)
+            added = len(cards)
+        if progress:
+            progress(processed, added)
+        return added, duplicates
+
+    def commit_progress(self, deck_name, cards, user_id):
+        with self._user(user_id) as manager:
+            updated = []
+            for card in cards:
+                card = Card.from_dict(card.to_dict())
+                card.last_revised = timestamp(card.last_revised)
+                card.due_at = timestamp(card.due_at)
+                updated.append(card)
+            return manager.update_cards(deck_name, updated, user_id)
+
+    # Learning Logic
+    def _sorted_cards(self, deck_name, user_id, key):
+        with self._user(user_id) as manager:
+            deck = manager.get_deck(deck_name)
+            if not deck:
+                return None
+            return sorted(deck.cards, key=key)
+
+    def select_cards_for_learning(self, deck_name, user_id):
+        cards = self._sorted_cards(deck_name, user_id, lambda c: (timestamp(c.due_at), c.id))
+        return cards[:6] if cards else []
+
+    def select_cards(self, deck_name, user_id):
+        return self._sorted_cards(deck_name, user_id, lambda c: (c.level, c.last_revised, c.id)) or []
+
+    def select_cards_page(self, deck_name, user_id, after=None, limit=5, count=True):
+        cards = self._sorted_cards(deck_name, user_id, lambda c: (c.level, c.last_revised, c.id))
+        if cards is None:
+            return CardPage([], False, 0)
+        remaining = cards
+        if after is not None:
+            after = tuple(after)
+            remaining = [card for card in cards if (card.level, card.last_revised, card.id) > after]
+        page = remaining[:limit]
+        has_next = len(remaining) > limit
+        next_after = (page[-1].level, page[-1].last_revised, page[-1].id) if has_next else None
+        return CardPage(page, has_next, len(cards) if count else None, next_after)
+
+    # Search
+    def search_cards(self, user_id, query, offset=0, limit=5):
+        if not query.strip():
+            return SearchPage([], False, offset)
+        with self._user(user_id) as manager:
+            hits = manager.search(query)
+        return SearchPage(
+            [(deck.name, card) for deck, card in hits[offset:offset + limit]],
+            len(hits) > offset + limit,
+            offset
+        )
+
+    def iter_export_rows(self, user_id, deck_name=None, fetch_size=500):
+        with self._user(user_id) as manager:
+            decks = [deck for deck in manager.decks if deck_name is None or deck.name == deck_name]
+            rows = []
+            for deck in sorted(decks, key=lambda d: (d.name, d.id)):
+                if not deck.cards:
+                    rows.append((deck.id, deck.name) + (None,) * 8)
+                for card in sorted(deck.cards, key=lambda c: (c.level, c.last_revised, c.id)):
+                    rows.append((deck.id, deck.name, card.id, card.front, card.back, card.last_revised, card.level,
+                                 card.ease, card.interval, card.due_at))
+        return iter(rows)
+
+    # Reminders
+    def due_counts(self, shard, shards, due_before, not_reminded_since, after="", limit=1000):
+        """
+        Scans every user file in data_dir; meant for small installations only. Only files named after
+        a numeric Telegram user id count, so other JSON files in the directory are left alone.
+        """
+        due_before, not_reminded_since = timestamp(due_before), timestamp(not_reminded_since)
+        user_ids = sorted({
+            os.path.splitext(name)[0] for name in os.listdir(self.data_dir or ".")
+            if name.endswith((".json", ".journal")) and os.path.splitext(name)[0].isdigit()
+        })
+        counts = []
+        for user_id in user_ids:
+            if user_id <= str(after) or zlib.crc32(user_id.encode("utf-8")) % shards != shard:
+                continue
+            settings = self._reminders.get(user_id, {})
+            last_sent_at = settings.get("last_sent_at")
+            if not settings.get("enabled", True) or (last_sent_at and last_sent_at >= not_reminded_since):
+                continue
+            try:
+                with self._user(user_id) as manager:
+                    due = sum(1 for deck in manager.decks for card in deck.cards if timestamp(card.due_at) <= due_before)
+            except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+                # One unreadable file must not stop the reminders of the whole shard
+                print(f"Skipping unreadable deck file of user {user_id}: {e!r}")
+                continue
+            if due:
+                counts.append((user_id, due))
+                if len(counts) >= limit:
+                    break
+        return counts
+
+    def mark_reminded(self, user_ids, sent_at):
+        if not user_ids:
+            return
+        with self._lock:
+            for user_id in user_ids:
+                self._reminders.setdefault(str(user_id), {})["last_sent_at"] = timestamp(sent_at)
+            self._save_reminders()
+
+    def set_reminders(self, user_id, enabled):
+        with self._lock:
+            self._reminders.setdefault(str(user_id), {})["enabled"] = bool(enabled)
+            self._save_reminders()
+
+    def close_connection(self):
+        with self._lock:
+            entries, self._users = list(self._users.values()), OrderedDict()
+        for entry in entries:
+            with entry.lock:
+                manager, entry.manager = entry.manager, None
+                if manager is not None:
+                    manager.close()
+                    with self._lock:
+                        self._file_operations += manager.file_operations
@@ -0,0 +1,459 @@
+from contextlib import contextmanager
+from datetime import datetime
+from models import Deck, Card, CardPage, SearchPage
+from storage import CountingCursor, StorageBackend, timestamp
+from services_db import card_key
+from search import like_pattern
+import metrics
+import sqlite3
+import threading
+import uuid
+import zlib
+import os
+
+
+SCHEMA_VERSION = 2
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS decks (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        user_id TEXT NOT NULL
+    )
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS decks_user_id_name_key ON decks (user_id, name)",
+    """
+    CREATE TABLE IF NOT EXISTS cards (
+        id TEXT PRIMARY KEY,
+        deck_id TEXT NOT NULL REFERENCES decks(id) ON DELETE CASCADE,
+        user_id TEXT NOT NULL,
+        front TEXT NOT NULL,
+        back TEXT NOT NULL,
+        last_revised TEXT NOT NULL,
+        level INTEGER NOT NULL DEFAULT 0,
+        ease REAL NOT NULL DEFAULT 2.5,
+        interval_days REAL NOT NULL DEFAULT 0,
+        due_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS cards_deck_due_idx ON cards (deck_id, due_at, id)",
+    "CREATE INDEX IF NOT EXISTS cards_deck_level_revised_id_idx ON cards (deck_id, level, last_revised, id)",
+    "CREATE INDEX IF NOT EXISTS cards_user_due_idx ON cards (user_id, due_at)",
+    """
+    CREATE TABLE IF NOT EXISTS reminder_settings (
+        user_id TEXT PRIMARY KEY,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        last_sent_at TEXT
+    )
+    """,
+    # Full-text index over front and back; the trigram tokenizer matches any substring of 3+ characters
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS cards_search
+    USING fts5(front, back, content='cards', content_rowid='rowid', tokenize='trigram')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS cards_search_insert AFTER INSERT ON cards BEGIN
+        INSERT INTO cards_search (rowid, front, back) VALUES (new.rowid, new.front, new.back);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS cards_search_delete AFTER DELETE ON cards BEGIN
+        INSERT INTO cards_search (cards_search, rowid, front, back) VALUES ('delete', old.rowid, old.front, old.back);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS cards_search_update AFTER UPDATE OF front, back ON cards BEGIN
+        INSERT INTO cards_search (cards_search, rowid, front, back) VALUES ('delete', old.rowid, old.front, old.back);
+        INSERT INTO cards_search (rowid, front, back) VALUES (new.rowid, new.front, new.back);
+    END
+    """,
+]
+
+CARD_COLUMNS = "id, front, back, last_revised, level, ease, interval_days, due_at"
+
+
+def _shard(user_id, shards):
+    return zlib.crc32(str(user_id).encode("utf-8")) % shards
+
+
+def _card(row):
+    return Card(row[1], row[2], row[0], row[3], row[4], row[5], row[6], row[7])
+
+
+class SQLiteDatabaseManager(StorageBackend):
+    def __init__(self, path=None, cached_statements=256):
+        """
+        Embedded storage for small deployments, tests and benchmarks: no server, one file.
+        Each worker thread gets its own connection. The database runs in WAL mode so readers never wait
+        for the writer, and every statement is a constant SQL string, so sqlite3's per-connection statement
+        cache prepares it once and reuses it.
+        :param path: The database file (SQLITE_PATH, default flashcards.db).
+        """
+        self.path = path or os.getenv("SQLITE_PATH", "flashcards.db")
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.statements = 0
+        self._connection().execute("PRAGMA journal_mode = WAL")
+        with self._cursor(write=True) as cursor:
+            cursor.execute("PRAGMA user_version")
+            version = cursor.fetchone()[0]
+            for statement in SCHEMA:
+                cursor.execute(statement)
+            if 0 < version < 2:
+                # Cards from before the search index
+                cursor.execute("INSERT INTO cards_search (cards_search) VALUES ('rebuild')")
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False,
+                cached_statements=self.cached_statements
+            )
+            connection.execute("PRAGMA foreign_keys = ON")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.create_function("shard_of", 2, _shard, deterministic=True)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextmanager
+    def _cursor(self, write=False):
+        """
+        One transaction; BEGIN IMMEDIATE takes the write lock up front for writes.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        cursor = connection.cursor()
+        if metrics.ENABLED:
+            cursor = metrics.InstrumentedCursor(cursor)
+        cursor = CountingCursor(cursor, self)
+        try:
+            yield cursor
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.close()
+
+    # Deck Management
+    def add_deck(self, name, user_id):
+        try:
+            with self._cursor(write=True) as cursor:
+                cursor.execute(
+                    "INSERT INTO decks (id, name, user_id) VALUES (?, ?, ?)",
+                    (str(uuid.uuid4()), name, str(user_id))
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def get_deck(self, name, user_id):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT id, name FROM decks WHERE user_id = ? AND name = ?", (str(user_id), name))
+            row = cursor.fetchone()
+        return Deck(name=row[1], id=row[0]) if row else None
+
+    def get_deck_by_id(self, deck_id, user_id):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT id, name FROM decks WHERE id = ? AND user_id = ?", (deck_id, str(user_id)))
+            row = cursor.fetchone()
+        return Deck(name=row[1], id=row[0]) if row else None
+
+    def delete_deck(self, name, user_id):
+        with self._cursor(write=True) as cursor:
+            cursor.execute("DELETE FROM decks WHERE user_id = ? AND name = ?", (str(user_id), name))
+
+    def get_all_decks(self, user_id):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT id, name FROM decks WHERE user_id = ? ORDER BY name", (str(user_id),))
+            rows = cursor.fetchall()
+        return [Deck(name=row[1], id=row[0]) for row in rows]
+
+    # Card Management
+    def add_card(self, deck_name, front, back, user_id):
+        now = datetime.now().isoformat()
+        with self._cursor(write=True) as cursor:
+            cursor.execute(
+                """
+                INSERT INTO cards (id, deck_id, user_id, front, back, last_revised, level, due_at)
+                SELECT ?, id, user_id, ?, ?, ?, 0, ? FROM decks WHERE user_id = ? AND name = ?
+                """,
+                (str(uuid.uuid4()), front, back, now, now, str(user_id), deck_name)
+            )
+            return cursor.rowcount > 0
+
+    def delete_card(self, deck_name, card_id, user_id):
+        with self._cursor(write=True) as cursor:
+            cursor.execute(
+                """
+                DELETE FROM cards WHERE id = ? AND user_id = ?
+                  AND deck_id = (SELECT id FROM decks WHERE user_id = ? AND name = ?)
+                """,
+                (card_id, str(user_id), str(user_id), deck_name)
+            )
+            return cursor.rowcount > 0
+
+    def edit_card(self, deck_name, card_id, level, user_id):
+        with self._cursor(write=True) as cursor:
+            cursor.execute(
+                """
+                UPDATE cards SET level = ?, last_revised = ?
+                WHERE id = ? AND user_id = ?
+                  AND deck_id = (SELECT id FROM decks WHERE user_id = ? AND name = ?)
+                """,
+                (level, datetime.now().isoformat(), card_id, str(user_id), str(user_id), deck_name)
+            )
+            return cursor.rowcount > 0
+
+    def import_cards(self, deck_name, rows, user_id, batch_size=1000, progress=None):
+        deck = self.get_deck(deck_name, user_id)
+        if not deck:
+            return None
+        added = duplicates = processed = 0
+        now = datetime.now().isoformat()
+        with self._cursor(write=True) as cursor:
+            cursor.execute("SELECT front, back FROM cards WHERE deck_id = ?", (deck.id,))
+            seen = {card_key(front, back) for front, back in cursor.fetchall()}
+            batch = []
+            for front, back in rows:
+                processed += 1
+                key = card_key(front, back)
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                batch.append((str(uuid.uuid4()), deck.id, str(user_id), front, back, now, now))
+                if len(batch) >= batch_size:
+                    added += self._insert_card_batch(cursor, batch)
+                    if progress:
+                        progress(processed, added)
+            added += self._insert_card_batch(cursor, batch)
+        if progress:
+            progress(processed, added)
+        return added, duplicates
+
+    def _insert_card_batch(self, cursor, batch):
+        if not batch:
+            return 0
+        cursor.executemany(
+            """
+            INSERT INTO cards (id, deck_id, user_id, front, back, last_revised, level, due_at)
+            VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+            """,
+            batch
+        )
+        count = len(batch)
+        batch.clear()
+        return count
+
+    def commit_progress(self, deck_name, cards, user_id):
+        cards = list(cards)
+        if not cards:
+            return 0
+        with self._cursor(write=True) as cursor:
+            cursor.execute("SELECT id FROM decks WHERE user_id = ? AND name = ?", (str(user_id), deck_name))
+            row = cursor.fetchone()
+            if not row:
+                return 0
+            cursor.executemany(
+                """
+                UPDATE cards SET level = ?, last_revised = ?, ease = ?, interval_days = ?, due_at = ?
+                WHERE id = ? AND deck_id = ? AND user_id = ?
+                """,
+                [
+                    (card.level, timestamp(card.last_revised), card.ease, card.interval, timestamp(card.due_at),
+                     card.id, row[0], str(user_id))
+                    for card in cards
+                ]
+            )
+            return cursor.rowcount
+
+    def reschedule_all(self, scheduler, batch_size=5000):
+        from scheduler import reschedule_batch
+        updated = 0
+        after = ""
+        while True:
+            with self._cursor(write=True) as cursor:
+                cursor.execute(
+                    "SELECT id, last_revised, interval_days, due_at FROM cards WHERE id > ? ORDER BY id LIMIT ?",
+                    (after, batch_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return updated
+                card_ids, last_revised, intervals, due_at = zip(*rows)
+                due_at = reschedule_batch(scheduler, last_revised, intervals, due_at)
+                cursor.executemany(
+                    "UPDATE cards SET due_at = ? WHERE id = ?",
+                    [(timestamp(value), card_id) for value, card_id in zip(due_at, card_ids)]
+                )
+                updated += len(rows)
+            after = card_ids[-1]
+
+    # Learning Logic
+    def select_cards_for_learning(self, deck_name, user_id):
+        with self._cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT {CARD_COLUMNS} FROM cards
+                WHERE deck_id = (SELECT id FROM decks WHERE user_id = ? AND name = ?)
+                ORDER BY due_at, id
+                LIMIT 6
+                """,
+                (str(user_id), deck_name)
+            )
+            return [_card(row) for row in cursor.fetchall()]
+
+    def select_cards(self, deck_name, user_id):
+        with self._cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT {CARD_COLUMNS} FROM cards
+                WHERE deck_id = (SELECT id FROM decks WHERE user_id = ? AND name = ?)
+                ORDER BY level, last_revised, id
+                """,
+                (str(user_id), deck_name)
+            )
+            return [_card(row) for row in cursor.fetchall()]
+
+    def select_cards_page(self, deck_name, user_id, after=None, limit=5, count=True):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT id FROM decks WHERE user_id = ? AND name = ?", (str(user_id), deck_name))
+            deck = cursor.fetchone()
+            if not deck:
+                return CardPage([], False, 0)
+            level, last_revised, card_id = after if after is not None else (-1, "", "")
+            cursor.execute(
+                f"""
+                SELECT {CARD_COLUMNS} FROM cards
+                WHERE deck_id = ? AND (level, last_revised, id) > (?, ?, ?)
+                ORDER BY level, last_revised, id
+                LIMIT ?
+                """,
+                (deck[0], level, last_revised, card_id, limit + 1)
+            )
+            rows = cursor.fetchall()
+            total = None
+            if count:
+                cursor.execute("SELECT count(*) FROM cards WHERE deck_id = ?", (deck[0],))
+                total = cursor.fetchone()[0]
+        cards = [_card(row) for row in rows[:limit]]
+        has_next = len(rows) > limit
+        next_after = (cards[-1].level, cards[-1].last_revised, cards[-1].id) if has_next else None
+        return CardPage(cards, has_next, total, next_after)
+
+    # Search
+    def search_cards(self, user_id, query, offset=0, limit=5):
+        """
+        Substring search through the FTS5 trigram index, ranked by bm25. Unlike Postgres there is no
+        typo tolerance, and queries shorter than three characters fall back to a LIKE scan.
+        """
+        query = query.strip()
+        if not query:
+            return SearchPage([], False, offset)
+        with self._cursor() as cursor:
+            if len(query) >= 3:
+                cursor.execute(
+                    """
+                    SELECT decks.name, cards.id, cards.front, cards.back, cards.last_revised, cards.level,
+                           cards.ease, cards.interval_days, cards.due_at
+                    FROM cards_search
+                    JOIN cards ON cards.rowid = cards_search.rowid
+                    JOIN decks ON decks.id = cards.deck_id
+                    WHERE cards_search MATCH ? AND cards.user_id = ?
+                    ORDER BY bm25(cards_search), decks.name, cards.id
+                    LIMIT ? OFFSET ?
+                    """,
+                    ('"' + query.replace('"', '""') + '"', str(user_id), limit + 1, offset)
+                )
+            else:
+                cursor.execute(
+                    """
+                    SELECT decks.name, cards.id, cards.front, cards.back, cards.last_revised, cards.level,
+                           cards.ease, cards.interval_days, cards.due_at
+                    FROM cards
+                    JOIN decks ON decks.id = cards.deck_id
+                    WHERE cards.user_id = ? AND (cards.front LIKE ? ESCAPE '\\' OR cards.back LIKE ? ESCAPE '\\')
+                    ORDER BY decks.name, cards.id
+                    LIMIT ? OFFSET ?
+                    """,
+                    (str(user_id), like_pattern(query), like_pattern(query), limit + 1, offset)
+                )
+            rows = cursor.fetchall()
+        hits = [(row[0], Card(row[2], row[3], row[1], *row[4:])) for row in rows[:limit]]
+        return SearchPage(hits, len(rows) > limit, offset)
+
+    def iter_export_rows(self, user_id, deck_name=None, fetch_size=500):
+        sql = """
+            SELECT decks.id, decks.name, cards.id, cards.front, cards.back, cards.last_revised, cards.level,
+                   cards.ease, cards.interval_days, cards.due_at
+            FROM decks LEFT JOIN cards ON cards.deck_id = decks.id
+            WHERE decks.user_id = ?
+        """
+        params = (str(user_id),)
+        if deck_name is not None:
+            sql += " AND decks.name = ?"
+            params += (deck_name,)
+        sql += " ORDER BY decks.name, decks.id, cards.level, cards.last_revised, cards.id"
+        with self._cursor() as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield from rows
+
+    # Reminders
+    def due_counts(self, shard, shards, due_before, not_reminded_since, after="", limit=1000):
+        with self._cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT cards.user_id, count(*)
+                FROM cards
+                LEFT JOIN reminder_settings ON reminder_settings.user_id = cards.user_id
+                WHERE cards.user_id > ? AND shard_of(cards.user_id, ?) = ? AND cards.due_at <= ?
+                  AND (reminder_settings.user_id IS NULL OR (
+                      reminder_settings.enabled
+                      AND (reminder_settings.last_sent_at IS NULL OR reminder_settings.last_sent_at < ?)
+                  ))
+                GROUP BY cards.user_id
+                ORDER BY cards.user_id
+                LIMIT ?
+                """,
+                (str(after), shards, shard, timestamp(due_before), timestamp(not_reminded_since), limit)
+            )
+            return cursor.fetchall()
+
+    def mark_reminded(self, user_ids, sent_at):
+        if not user_ids:
+            return
+        with self._cursor(write=True) as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO reminder_settings (user_id, last_sent_at) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET last_sent_at = excluded.last_sent_at
+                """,
+                [(str(user_id), timestamp(sent_at)) for user_id in user_ids]
+            )
+
+    def set_reminders(self, user_id, enabled):
+        with self._cursor(write=True) as cursor:
+            cursor.execute(
+                """
+                INSERT INTO reminder_settings (user_id, enabled) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET enabled = excluded.enabled
+                """,
+                (str(user_id), int(enabled))
+            )
+
+    def close_connection(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,342 @@
+from collections import OrderedDict
+from datetime import datetime
+from models import Card
+import asyncio
+import json
+import os
+import time
+
+
+def encode_state(state):
+    # Cards are written as their id only
+    def default(value):
+        if isinstance(value, Card):
+            return {"__card__": value.id}
+        if isinstance(value, datetime):
+            return value.isoformat()
+        raise TypeError(f"Cannot serialize {type(value).__name__} in session state")
+    return json.dumps(state, default=default, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_state(data, cards=None):
+    """
+    :param cards: Card id -> Card; cards missing from it, e.g. deleted since, decode as None.
+    """
+    cards = cards or {}
+
+    def object_hook(value):
+        if "__card__" in value:
+            return cards.get(value["__card__"])
+        return value
+    return json.loads(data, object_hook=object_hook)
+
+
+class FileSessionBackend:
+    def __init__(self, directory=None, max_age=None):
+        """
+        One small JSON file per spilled session.
+        :param directory: Where session files live (SESSION_DIR, default "sessions").
+        :param max_age: Seconds after which a spilled session is discarded (SESSION_MAX_AGE).
+        """
+        self.directory = directory or os.getenv("SESSION_DIR", "sessions")
+        self.max_age = max_age or float(os.getenv("SESSION_MAX_AGE", str(7 * 24 * 3600)))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, namespace, key):
+        return os.path.join(self.directory, f"{namespace}-{key}.json")
+
+    def save(self, namespace, key, data):
+        path = self._path(namespace, key)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def save_many(self, namespace, items):
+        for key, data in items:
+            self.save(namespace, key, data)
+
+    def load(self, namespace, key):
+        path = self._path(namespace, key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, namespace, key):
+        try:
+            os.remove(self._path(namespace, key))
+        except FileNotFoundError:
+            pass
+
+
+class PostgresSessionBackend:
+    def __init__(self, pool, max_age=None):
+        """
+        Spilled sessions in the sessions table (see migrations).
+        :param pool: A db_pool.ConnectionPool.
+        :param max_age: Seconds after which a spilled session is discarded (SESSION_MAX_AGE).
+        """
+        self.pool = pool
+        self.max_age = max_age or float(os.getenv("SESSION_MAX_AGE", str(7 * 24 * 3600)))
+
+    def save(self, namespace, key, data):
+        self.save_many(namespace, [(key, data)])
+
+    def save_many(self, namespace, items):
+        items = list(items)
+        if not items:
+            return
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO sessions (namespace, user_id, state, updated_at)
+                SELECT %s, item.user_id, item.state, now()
+                FROM unnest(CAST(%s AS TEXT[]), CAST(%s AS TEXT[])) AS item(user_id, state)
+                ON CONFLICT (namespace, user_id) DO UPDATE SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at
+                """,
+                (namespace, [key for key, _ in items], [data for _, data in items])
+            )
+
+    def load(self, namespace, key):
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT state FROM sessions
+                WHERE namespace = %s AND user_id = %s AND updated_at > now() - make_interval(secs => %s)
+                """,
+                (namespace, key, self.max_age)
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def delete(self, namespace, key):
+        with self.pool.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM sessions WHERE namespace = %s AND user_id = %s",
+                (namespace, key)
+            )
+
+
+def create_session_backend(pool=None):
+    """
+    Build the backend named by SESSION_BACKEND: "file" (the default), "postgres" or "memory"
+    (no persistence: evicted sessions are dropped).
+    """
+    kind = os.getenv("SESSION_BACKEND", "file")
+    if kind == "file":
+        return FileSessionBackend()
+    if kind == "postgres":
+        if pool is None:
+            raise ValueError("The postgres session backend needs a connection pool")
+        return PostgresSessionBackend(pool)
+    if kind == "memory":
+        return None
+    raise ValueError(f"Unknown SESSION_BACKEND '{kind}'")
+
+
+class SessionStore:
+    def __init__(self, namespace, backend=None, max_entries=None, ttl=None, sweep_interval=None, executor=None,
+                 find_cards=None):
+        """
+        Dict-like per-user state with LRU and idle-TTL eviction.
+        Evicted entries are spilled to the backend and restored by load() before the user's next update;
+        without a backend they are dropped, and the user starts over with no session.
+        Backend I/O runs on executor, never on the event loop; writes are applied in order.
+        :param namespace: Distinguishes stores that share a backend.
+        :param executor: Where backend calls run, e.g. the database executor; the loop's default when None.
+        :param find_cards: Coroutine function (user_id, state) -> {card id: Card} that looks up again
+                           the cards of a restored session, which are spilled as ids.
+        :param max_entries: Sessions kept in memory (SESSION_MAX_ENTRIES).
+        :param ttl: Idle seconds before a session is spilled (SESSION_TTL).
+        :param sweep_interval: Minimum seconds between idle sweeps (SESSION_SWEEP_INTERVAL).
+        """
+        self.namespace = namespace
+        self.backend = backend
+        self.max_entries = max_entries or int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+        self.ttl = ttl or float(os.getenv("SESSION_TTL", "1800"))
+        self.sweep_interval = sweep_interval or float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+        self.executor = executor
+        self.find_cards = find_cards
+        self._entries = OrderedDict()  # user_id -> [state, last_access]
+        # Users known to have nothing in the backend, so their updates skip the lookup
+        self._absent = OrderedDict()  # user_id -> None
+        self._last_sweep = time.monotonic()
+        self._last_write = None  # task of the latest backend write
+        self._writing = {}  # user_id -> task of the latest write touching the user's session
+
+    def _write(self, user_ids, operation, *args):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop, e.g. a script: nothing to block
+            operation(*args)
+            return
+        previous = self._last_write
+
+        async def write():
+            if previous is not None:
+                await asyncio.wait([previous])
+            await loop.run_in_executor(self.executor, operation, *args)
+
+        task = loop.create_task(write())
+        self._last_write = task
+        for user_id in user_ids:
+            self._writing[user_id] = task
+        task.add_done_callback(lambda done: self._written(user_ids, done))
+
+    def _written(self, user_ids, task):
+        for user_id in user_ids:
+            if self._writing.get(user_id) is task:
+                del self._writing[user_id]
+        if self._last_write is task:
+            self._last_write = None
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Could not write {len(user_ids)} {self.namespace} sessions: {task.exception()!r}")
+
+    def _spill(self, items):
+        for user_id, _ in items:
+            self._absent.pop(user_id, None)
+        if self.backend is not None and items:
+            self._write(
+                [user_id for user_id, _ in items], self.backend.save_many,
+                self.namespace, [(str(user_id), encode_state(state)) for user_id, state in items]
+            )
+
+    async def load(self, user_id):
+        """
+        Bring the user's spilled session back into memory, if any. Call before handling the user's update.
+        """
+        if self.backend is None or user_id in self._entries or user_id in self._absent:
+            return
+        pending = self._writing.get(user_id)
+        if pending is not None:
+            # The session is on its way to the backend
+            await asyncio.wait([pending])
+        data = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.backend.load, self.namespace, str(user_id)
+        )
+        if data is None:
+            if user_id not in self._entries:
+                self._mark_absent(user_id)
+            return
+        state = decode_state(data)
+        if self.find_cards is not None and '"__card__"' in data:
+            state = decode_state(data, await self.find_cards(user_id, state))
+        if user_id not in self._entries:
+            self._entries[user_id] = [state, time.monotonic()]
+            self._evict_overflow()
+
+    def _mark_absent(self, user_id):
+        self._absent[user_id] = None
+        while len(self._absent) > self.max_entries:
+            self._absent.popitem(last=False)
+
+    async def wait_written(self):
+        """
+        Wait until every spilled or deleted session has reached the backend.
+        """
+        while self._last_write is not None:
+            await asyncio.wait([self._last_write])
+
+    def _touch(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry[1] = time.monotonic()
+            self._entries.move_to_end(user_id)
+        self._maybe_sweep()
+        return entry
+
+    def _evict_overflow(self):
+        overflow = []
+        while len(self._entries) > self.max_entries:
+            user_id, (state, _) = self._entries.popitem(last=False)
+            overflow.append((user_id, state))
+        self._spill(overflow)
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = now
+            self.spill_idle(now)
+
+    def spill_idle(self, now=None):
+        """
+        Move every session idle for longer than the TTL out of memory.
+        :return: The number of sessions spilled.
+        """
+        now = now or time.monotonic()
+        idle = []
+        # Entries are kept in access order, so the idle ones are at the front
+        for user_id, (state, last_access) in self._entries.items():
+            if now - last_access <= self.ttl:
+                break
+            idle.append((user_id, state))
+        for user_id, _ in idle:
+            del self._entries[user_id]
+        self._spill(idle)
+        return len(idle)
+
+    async def flush(self):
+        """
+        Persist every in-memory session, e.g. before shutdown.
+        """
+        self._spill([(user_id, state) for user_id, (state, _) in self._entries.items()])
+        await self.wait_written()
+
+    async def release(self, predicate):
+        """
+        Spill the sessions of the users matching predicate, e.g. users now served by another worker.
+        Returns once they are in the backend, so their new owner can load them.
+        :return: The number of sessions released.
+        """
+        released = [(user_id, state) for user_id, (state, _) in self._entries.items() if predicate(user_id)]
+        for user_id, _ in released:
+            del self._entries[user_id]
+        self._spill(released)
+        # Membership changed: users moving here may have been spilled by their previous worker
+        self._absent.clear()
+        await self.wait_written()
+        return len(released)
+
+    def get(self, user_id, default=None):
+        entry = self._touch(user_id)
+        return entry[0] if entry is not None else default
+
+    def pop(self, user_id, default=None):
+        entry = self._touch(user_id)
+        if entry is None:
+            return default
+        del self._entries[user_id]
+        if self.backend is not None:
+            self._write([user_id], self.backend.delete, self.namespace, str(user_id))
+            self._mark_absent(user_id)
+        return entry[0]
+
+    def setdefault(self, user_id, default):
+        entry = self._touch(user_id)
+        if entry is not None:
+            return entry[0]
+        self[user_id] = default
+        return default
+
+    def __getitem__(self, user_id):
+        entry = self._touch(user_id)
+        if entry is None:
+            raise KeyError(user_id)
+        return entry[0]
+
+    def __setitem__(self, user_id, state):
+        self._absent.pop(user_id, None)
+        self._entries[user_id] = [state, time.monotonic()]
+        self._entries.move_to_end(user_id)
+        self._evict_overflow()
+
+    def __contains__(self, user_id):
+        return self._touch(user_id) is not None
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,540 @@
+"""
+Multi-worker mode: a dispatcher receives Telegram's webhook and forwards every update to one of
+several bot workers, chosen by a consistent hash of the user id. A user always lands on the same
+worker, so session state stays in that worker's memory and the bot scales past one core.
+
+Workers register themselves with POST /workers/join and leave with POST /workers/leave; a worker
+that stops answering is dropped. The dispatcher and the workers refuse to start without SHARD_SECRET,
+which the /workers endpoints and the workers themselves require, as the dispatcher shares its port
+with the public webhook. Because of the hash ring only about 1/N of the users move when
+membership changes. While membership changes, updates of the users changing workers are held back
+and the ones already sent are let finish; then the old owners are told the new membership and spill
+the sessions of the users they lose, and with a shared SESSION_BACKEND (postgres, or file on one
+machine) the new owner restores them on the user's next update. A worker acknowledges each update
+of a batch as soon as its handler has run, and sends a heartbeat meanwhile, so a slow handler holds
+up only its own user; updates a worker that dies did not acknowledge are handed to the next one.
+Workers do not send reminders unless started with REMINDERS_ENABLED=1; set it on exactly one worker.
+
+    python sharding.py dispatcher                   # WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, DISPATCHER_PORT
+    BOT_MODE=worker WORKER_PORT=8601 python bot.py  # one per worker, DISPATCHER_URL
+
+Everything on one machine, with webhook_stub.py standing in for Telegram and generating updates:
+
+    python sharding.py local --workers 4 --users 200 --updates 5
+"""
+from bisect import bisect
+from update_processor import UserLocks
+import argparse
+import asyncio
+import hashlib
+import hmac
+import httpx
+import json
+import os
+import secrets
+import signal
+import subprocess
+import sys
+
+
+class HashRing:
+    def __init__(self, nodes=(), replicas=None):
+        """
+        Consistent hash ring; every node owns `replicas` points so load stays even.
+        :param replicas: Points per node (SHARD_REPLICAS, default 100).
+        """
+        self.replicas = replicas or int(os.getenv("SHARD_REPLICAS", "100"))
+        self._points = []  # sorted hashes
+        self._owners = {}  # hash -> node
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "big")
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = self._hash(f"{node}#{i}")
+            if point not in self._owners:
+                self._owners[point] = node
+                self._points.insert(bisect(self._points, point), point)
+
+    def remove(self, node):
+        self._points = [point for point in self._points if self._owners[point] != node]
+        self._owners = {point: owner for point, owner in self._owners.items() if owner != node}
+
+    def nodes(self):
+        return sorted(set(self._owners.values()))
+
+    def node_for(self, key):
+        if not self._points:
+            return None
+        i = bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[self._points[i]]
+
+
+def update_user_id(data):
+    """
+    The user an update (as received from Telegram) belongs to: the sender, or the chat when there is none.
+    """
+    for name, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "voter_chat", "chat"):
+            if isinstance(value.get(field), dict) and "id" in value[field]:
+                return value[field]["id"]
+    return data.get("update_id")
+
+
+async def read_request(reader):
+    """
+    :return: (method, path, headers, body) of one HTTP/1.1 request, or None on a closed connection.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", "0")))
+    return method, path.split("?")[0], headers, body
+
+
+async def respond(writer, status, body=b""):
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+
+
+class WorkerGone(Exception):
+    pass
+
+
+def shard_secret_or_fail(shard_secret=None):
+    shard_secret = shard_secret or os.getenv("SHARD_SECRET")
+    if not shard_secret:
+        raise ValueError("SHARD_SECRET must be set, or anyone could join as a worker and receive updates")
+    return shard_secret
+
+
+def has_shard_secret(headers, shard_secret):
+    return hmac.compare_digest(headers.get("x-shard-secret", "").encode("utf-8"), shard_secret.encode("utf-8"))
+
+
+class _Worker:
+    def __init__(self, url):
+        self.url = url
+        self.queue = asyncio.Queue()  # (update, future)
+        self.task = None
+        self.requests = set()  # tasks of the batches in flight
+
+
+class Dispatcher:
+    def __init__(self, path=None, secret=None, shard_secret=None, max_batch=100):
+        """
+        :param path: URL path Telegram posts updates to (WEBHOOK_PATH).
+        :param secret: Expected X-Telegram-Bot-Api-Secret-Token (WEBHOOK_SECRET).
+        :param shard_secret: Shared with the workers for the /workers endpoints (SHARD_SECRET).
+        :param max_batch: Updates forwarded to a worker in one request.
+        """
+        self.path = "/" + (path if path is not None else os.getenv("WEBHOOK_PATH", "")).strip("/")
+        self.secret = secret or os.getenv("WEBHOOK_SECRET")
+        self.shard_secret = shard_secret_or_fail(shard_secret)
+        self.max_batch = max_batch
+        self.ring = HashRing()
+        self.workers = {}
+        self.joined = asyncio.Event()
+        self._membership = asyncio.Lock()
+        self._moving = None  # predicate on user ids changing workers while membership changes
+        self._settled = asyncio.Event()
+        self._settled.set()
+        self._outstanding = {}  # future of an update sent to a worker -> its user id
+        self._users = UserLocks()  # one update per user in flight keeps each user's updates in order
+        self.client = httpx.AsyncClient(timeout=30, headers={"X-Shard-Secret": self.shard_secret})
+
+    async def handle(self, reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, headers, body = request
+            if method != "POST":
+                await respond(writer, "405 Method Not Allowed")
+            elif path.startswith("/workers/"):
+                if not has_shard_secret(headers, self.shard_secret):
+                    await respond(writer, "403 Forbidden")
+                    return
+                url = json.loads(body)["url"]
+                if path == "/workers/join":
+                    await self.join(url)
+                else:
+                    await self.leave(url, graceful=True)
+                await respond(writer, "200 OK", json.dumps({"workers": self.ring.nodes()}).encode("utf-8"))
+            elif path == self.path:
+                if self.secret and headers.get("x-telegram-bot-api-secret-token") != self.secret:
+                    await respond(writer, "403 Forbidden")
+                    return
+                try:
+                    await self.dispatch(json.loads(body))
+                except WorkerGone:
+                    # Telegram redelivers the update later
+                    await respond(writer, "503 Service Unavailable")
+                    return
+                await respond(writer, "200 OK")
+            else:
+                await respond(writer, "404 Not Found")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, update):
+        """
+        Hand an update to its user's worker and wait until the worker has handled it.
+        A worker that fails is dropped and the update goes to the user's next worker.
+        """
+        key = update_user_id(update)
+        async with self._users.hold(key):
+            await self._deliver(key, update)
+
+    async def _deliver(self, key, update):
+        while True:
+            while self._moving is not None and self._moving(key):
+                await self._settled.wait()
+            worker = self.workers.get(self.ring.node_for(key))
+            if worker is None:
+                raise WorkerGone("No workers")
+            future = asyncio.get_running_loop().create_future()
+            self._outstanding[future] = key
+            worker.queue.put_nowait((update, future))
+            try:
+                await future
+                return
+            except (httpx.HTTPError, WorkerGone) as e:
+                print(f"Worker {worker.url} failed ({e!r}), dropping it")
+                await self.leave(worker.url)
+            finally:
+                del self._outstanding[future]
+
+    async def _forward(self, worker):
+        # Batches go out without waiting for the previous ones: a user never has two updates in flight,
+        # so their order holds, and the webhook's own concurrency bounds the requests in flight
+        while True:
+            batch = [await worker.queue.get()]
+            while len(batch) < self.max_batch and not worker.queue.empty():
+                batch.append(worker.queue.get_nowait())
+            request = asyncio.create_task(self._send(worker, batch))
+            worker.requests.add(request)
+            request.add_done_callback(worker.requests.discard)
+
+    async def _send(self, worker, batch):
+        # The worker answers with the index of every update once handled, and an empty line while
+        # it is busy, so only a worker that stops answering runs into the client's read timeout
+        futures = dict(enumerate(future for _, future in batch))
+        error = WorkerGone(worker.url)
+        try:
+            async with self.client.stream(
+                "POST", worker.url + "/updates", json=[update for update, _ in batch]
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line.strip():
+                        future = futures.pop(int(line))
+                        if not future.done():
+                            future.set_result(None)
+            if futures:
+                error = WorkerGone(f"{worker.url} closed the batch before handling all of it")
+        except httpx.HTTPError as e:
+            error = e
+        finally:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def _announce(self, members, urls=None):
+        urls = list(self.workers) if urls is None else urls
+        results = await asyncio.gather(*(
+            self.client.post(url + "/rebalance", json={"workers": members}) for url in urls
+        ), return_exceptions=True)
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                print(f"Could not tell {url} about the new membership: {result!r}")
+
+    def _pause(self, moving):
+        # Hold back new updates of the users matching moving
+        self._moving = moving
+        self._settled.clear()
+
+    def _resume(self):
+        self._moving = None
+        self._settled.set()
+
+    async def _drain(self, moving):
+        # Wait until every update already sent for the users matching moving has been handled
+        pending = [future for future, key in self._outstanding.items() if moving(key)]
+        if pending:
+            await asyncio.wait(pending)
+
+    async def join(self, url):
+        async with self._membership:
+            if url in self.workers:
+                return
+            members = HashRing(self.ring.nodes() + [url])
+            moving = lambda key: members.node_for(key) == url
+            self._pause(moving)
+            try:
+                # Current owners finish with the users moving to the new worker, then give them up
+                await self._drain(moving)
+                await self._announce(members.nodes())
+                worker = _Worker(url)
+                worker.task = asyncio.create_task(self._forward(worker))
+                self.workers[url] = worker
+                self.ring.add(url)
+            finally:
+                self._resume()
+        self.joined.set()
+        print(f"Worker {url} joined, {len(self.workers)} workers")
+
+    async def leave(self, url, graceful=False):
+        """
+        :param graceful: The worker asked to leave and still answers: let it finish its updates and
+                         spill its sessions first. Otherwise it failed and its updates are retried.
+        """
+        async with self._membership:
+            worker = self.workers.get(url)
+            if worker is None:
+                return
+            ring = HashRing(self.ring.nodes())
+            moving = lambda key: ring.node_for(key) == url
+            self._pause(moving)
+            try:
+                if graceful:
+                    await self._drain(moving)
+                    await self._announce([node for node in ring.nodes() if node != url], [url])
+                del self.workers[url]
+                self.ring.remove(url)
+                worker.task.cancel()
+                for request in list(worker.requests):
+                    request.cancel()
+                while not worker.queue.empty():
+                    _, future = worker.queue.get_nowait()
+                    if not future.done():
+                        future.set_exception(WorkerGone(url))
+                await self._announce(self.ring.nodes())
+            finally:
+                self._resume()
+        print(f"Worker {url} left, {len(self.workers)} workers")
+
+    async def set_webhook(self, token, url, base_url=None):
+        base_url = base_url or os.getenv("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+        data = {"url": url}
+        if self.secret:
+            data["secret_token"] = self.secret
+        async with httpx.AsyncClient(timeout=30) as client:
+            response = await client.post(f"{base_url}{token}/setWebhook", data=data)
+            response.raise_for_status()
+
+    async def close(self):
+        for worker in self.workers.values():
+            worker.task.cancel()
+            for request in list(worker.requests):
+                request.cancel()
+        await self.client.aclose()
+
+
+async def run_dispatcher(host=None, port=None, min_workers=1, stop=None):
+    """
+    Serve the webhook and the worker endpoints, and point the bot's webhook at WEBHOOK_URL once
+    min_workers workers have joined.
+    """
+    dispatcher = Dispatcher()
+    host = host or os.getenv("DISPATCHER_HOST", "0.0.0.0")
+    port = port or int(os.getenv("DISPATCHER_PORT", "8443"))
+    server = await asyncio.start_server(dispatcher.handle, host, port)
+    print(f"Dispatcher listening on {host}:{port}")
+    stop = stop or _stop_event()
+    async with server:
+        while len(dispatcher.workers) < min_workers:
+            dispatcher.joined.clear()
+            await dispatcher.joined.wait()
+        if os.getenv("WEBHOOK_URL"):
+            await dispatcher.set_webhook(os.getenv("BOT_TOKEN"), os.getenv("WEBHOOK_URL"))
+        await stop.wait()
+    await dispatcher.close()
+
+
+def _stop_event():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+async def run_worker(app, release_sessions, host=None, port=None, url=None, dispatcher_url=None):
+    """
+    Run the application as one worker behind the dispatcher until SIGINT/SIGTERM.
+    :param release_sessions: Coroutine function called with a predicate on user ids; spills the matching sessions.
+    :param url: How the dispatcher reaches this worker (WORKER_URL, default http://host:port).
+    Busy batches send a heartbeat every SHARD_HEARTBEAT seconds (default 10), well within the
+    dispatcher's 30 s read timeout.
+    """
+    from telegram import Update
+    host = host or os.getenv("WORKER_HOST", "127.0.0.1")
+    port = port or int(os.getenv("WORKER_PORT", "8600"))
+    url = url or os.getenv("WORKER_URL", f"http://{host}:{port}")
+    dispatcher_url = dispatcher_url or os.getenv("DISPATCHER_URL", "http://127.0.0.1:8443")
+    shard_secret = shard_secret_or_fail()
+    heartbeat = float(os.getenv("SHARD_HEARTBEAT", "10"))
+
+    async def process(i, update):
+        try:
+            await app.update_processor.process_update(update, app.process_update(update))
+        except Exception as e:
+            print(f"Update failed: {e!r}")
+        return i
+
+    async def handle_updates(writer, updates):
+        # Each update is acknowledged once handled, so the dispatcher retries only what a dying
+        # worker did not finish and a slow handler does not hold back the rest of the batch
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\n")
+        pending = {asyncio.create_task(process(i, update)) for i, update in enumerate(updates)}
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+            writer.write(b"".join(f"{task.result()}\n".encode("ascii") for task in done) or b"\n")
+            await writer.drain()
+
+    async def handle(reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, headers, body = request
+            if not has_shard_secret(headers, shard_secret):
+                await respond(writer, "403 Forbidden")
+            elif method == "POST" and path == "/updates":
+                await handle_updates(writer, [Update.de_json(data, app.bot) for data in json.loads(body)])
+            elif method == "POST" and path == "/rebalance":
+                ring = HashRing(json.loads(body)["workers"])
+                released = await release_sessions(lambda user_id: ring.node_for(user_id) != url)
+                if released:
+                    print(f"Released {released} sessions to other workers")
+                await respond(writer, "200 OK")
+            else:
+                await respond(writer, "404 Not Found")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def call_dispatcher(action):
+        async with httpx.AsyncClient(timeout=30, headers={"X-Shard-Secret": shard_secret}) as client:
+            response = await client.post(f"{dispatcher_url}/workers/{action}", json={"url": url})
+            response.raise_for_status()
+
+    stop = _stop_event()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    server = await asyncio.start_server(handle, host, port)
+    try:
+        for attempt in range(60):
+            try:
+                await call_dispatcher("join")
+                break
+            except httpx.HTTPError:
+                await asyncio.sleep(1)
+        else:
+            raise RuntimeError(f"Dispatcher at {dispatcher_url} did not answer")
+        print(f"Worker {url} joined {dispatcher_url}")
+        await stop.wait()
+        try:
+            await call_dispatcher("leave")
+        except httpx.HTTPError as e:
+            print(f"Could not leave {dispatcher_url}: {e!r}")
+    finally:
+        server.close()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+async def run_local(args):
+    """
+    Dispatcher in this process; webhook_stub.py and the workers as child processes.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(
+        os.environ,
+        BOT_TOKEN=os.getenv("BOT_TOKEN", "1:stub"),
+        BOT_API_BASE_URL=f"http://127.0.0.1:{args.api_port}/bot",
+        DISPATCHER_URL=f"http://127.0.0.1:{args.port}",
+        WEBHOOK_URL=f"http://127.0.0.1:{args.port}/telegram",
+        WEBHOOK_PATH="telegram",
+        REMINDERS_ENABLED="0",
+        SHARD_SECRET=os.getenv("SHARD_SECRET") or secrets.token_hex(16),
+    )
+    env.setdefault("STORAGE_BACKEND", "sqlite")
+    env.setdefault("CONCURRENT_UPDATES", "32")
+    os.environ.update(env)
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(here, "webhook_stub.py"), "--port", str(args.api_port),
+        "--webhook", env["WEBHOOK_URL"], "--users", str(args.users), "--updates", str(args.updates),
+        "--concurrency", str(args.concurrency)
+    ], env=env)
+    workers = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(here, "bot.py")],
+            env=dict(env, BOT_MODE="worker", WORKER_PORT=str(args.port + 1 + i))
+        )
+        for i in range(args.workers)
+    ]
+    stop = asyncio.Event()
+    dispatcher = asyncio.create_task(run_dispatcher("127.0.0.1", args.port, args.workers, stop))
+    try:
+        while stub.poll() is None and not dispatcher.done():
+            await asyncio.sleep(0.2)
+    finally:
+        # Workers first, so they can still leave the dispatcher
+        for process in workers + [stub]:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        while any(process.poll() is None for process in workers + [stub]):
+            await asyncio.sleep(0.1)
+        stop.set()
+        await dispatcher
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    dispatcher = commands.add_parser("dispatcher", help="Run the dispatcher")
+    dispatcher.add_argument("--min-workers", type=int, default=1, help="Workers to wait for before setting the webhook")
+    local = commands.add_parser("local", help="Run the stub Bot API, the dispatcher and the workers on this machine")
+    local.add_argument("--workers", type=int, default=4)
+    local.add_argument("--users", type=int, default=100)
+    local.add_argument("--updates", type=int, default=5, help="Updates per user")
+    local.add_argument("--concurrency", type=int, default=32, help="Parallel webhook posts")
+    local.add_argument("--port", type=int, default=8443, help="Dispatcher port; workers use the following ports")
+    local.add_argument("--api-port", type=int, default=8081, help="Port of the stub Bot API")
+    args = parser.parse_args()
+    if args.command == "dispatcher":
+        asyncio.run(run_dispatcher(min_workers=args.min_workers))
+    else:
+        asyncio.run(run_local(args))
+
+
+if __name__ == "__main__":
+    main()
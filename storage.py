@@ -0,0 +1,166 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+import os
+
+
+class StorageBackend(ABC):
+    """
+    What the bot needs from a deck store. Methods are synchronous and must be safe to call from the
+    worker threads of AsyncDatabaseManager. Decks are addressed by name within a user.
+    """
+
+    # Deck Management
+    @abstractmethod
+    def add_deck(self, name, user_id):
+        """
+        :return: False when the user already has a deck with that name.
+        """
+
+    @abstractmethod
+    def get_deck(self, name, user_id):
+        """
+        :return: The Deck (without cards) or None.
+        """
+
+    @abstractmethod
+    def get_deck_by_id(self, deck_id, user_id):
+        pass
+
+    @abstractmethod
+    def delete_deck(self, name, user_id):
+        pass
+
+    @abstractmethod
+    def get_all_decks(self, user_id):
+        """
+        :return: The user's decks (without cards), sorted by name.
+        """
+
+    # Card Management
+    @abstractmethod
+    def add_card(self, deck_name, front, back, user_id):
+        pass
+
+    @abstractmethod
+    def delete_card(self, deck_name, card_id, user_id):
+        pass
+
+    @abstractmethod
+    def edit_card(self, deck_name, card_id, level, user_id):
+        """
+        Set a card's level; only a card of the user's deck named deck_name is changed.
+        :return: Whether the card was found.
+        """
+
+    @abstractmethod
+    def import_cards(self, deck_name, rows, user_id, batch_size=1000, progress=None):
+        """
+        Add many (front, back) rows, skipping pairs the deck already has. All or nothing: when reading
+        the rows fails, no card is added.
+        :param progress: Optional callable(processed, added) invoked after every batch.
+        :return: (added, duplicates), or None when the deck does not exist.
+        """
+
+    @abstractmethod
+    def commit_progress(self, deck_name, cards, user_id):
+        """
+        Store the level and scheduling state of reviewed Cards.
+        :return: The number of cards updated.
+        """
+
+    def reschedule_all(self, scheduler, batch_size=5000):
+        raise NotImplementedError(f"{type(self).__name__} cannot reschedule")
+
+    # Learning Logic
+    @abstractmethod
+    def select_cards_for_learning(self, deck_name, user_id):
+        """
+        :return: Up to six cards, earliest due_at first.
+        """
+
+    @abstractmethod
+    def select_cards(self, deck_name, user_id):
+        pass
+
+    @abstractmethod
+    def select_cards_page(self, deck_name, user_id, after=None, limit=5, count=True):
+        """
+        :return: A CardPage in (level, last_revised, id) order starting after the keyset `after`.
+        """
+
+    @abstractmethod
+    def search_cards(self, user_id, query, offset=0, limit=5):
+        """
+        Find cards across all of a user's decks by front and back.
+        :return: A SearchPage of (deck_name, Card), substring matches first, then by similarity.
+        """
+
+    @abstractmethod
+    def iter_export_rows(self, user_id, deck_name=None, fetch_size=500):
+        """
+        :return: Iterable of (deck_id, deck_name, card_id, front, back, last_revised, level, ease,
+                 interval_days, due_at) grouped by deck; card columns are None for an empty deck.
+        """
+
+    # Reminders
+    @abstractmethod
+    def due_counts(self, shard, shards, due_before, not_reminded_since, after="", limit=1000):
+        pass
+
+    @abstractmethod
+    def mark_reminded(self, user_ids, sent_at):
+        pass
+
+    @abstractmethod
+    def set_reminders(self, user_id, enabled):
+        pass
+
+    @abstractmethod
+    def close_connection(self):
+        pass
+
+
+def timestamp(value):
+    # Datetimes as ISO strings for text columns, files and exports
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class CountingCursor:
+    def __init__(self, cursor, owner):
+        """
+        Counts the statements executed through cursor in owner.statements, for benchmarks.
+        """
+        self._cursor = cursor
+        self._owner = owner
+
+    def execute(self, *args, **kwargs):
+        self._owner.statements += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._owner.statements += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+BACKENDS = ("postgres", "sqlite", "json")
+
+
+def create_backend(name=None):
+    """
+    Build the backend named by STORAGE_BACKEND: "postgres" (default, DATABASE_URL), "sqlite"
+    (SQLITE_PATH, default flashcards.db) or "json" (one file per user in JSON_DATA_DIR, default ".").
+    """
+    name = name or os.getenv("STORAGE_BACKEND", "postgres")
+    if name == "postgres":
+        from services_db import DatabaseManager
+        return DatabaseManager()
+    if name == "sqlite":
+        from services_sqlite import SQLiteDatabaseManager
+        return SQLiteDatabaseManager()
+    if name == "json":
+        from services import JsonStorage
+        return JsonStorage()
+    raise ValueError(f"Unknown STORAGE_BACKEND '{name}'")
@@ -1,93 +1,240 @@
-import json
-import pg8000
-from urllib.parse import urlparse
+"""
+Bulk import of per-user JSON deck files (<user_id>.json as written by services.py, or the
+<user_id>.json.gz sent by /export) into Postgres.
+
+    python transfer_from_json_to_db.py --workers 8 'data/*.json'
+
+Each file is imported in its own transaction together with a row in import_files, so an
+interrupted run can simply be started again: finished files are skipped and a file whose
+content changed is re-applied. Deck and card ids from the files are kept.
+services.py keeps recent changes in <user_id>.journal until it compacts; stop the bot first so
+every journal is folded into its snapshot.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from db_pool import ConnectionPool, connect_params
+from migrations import migrate
+import argparse
+import hashlib
 import glob
+import gzip
+import json
 import os
-import random
+import pg8000
 import time
 import uuid
 
 
-def generate_uuid4():
-    rnd = (random.Random())
-    rnd.seed(time.time() * 1000)
-    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
-
-def insert_data_from_json_files(database_url, json_files):
-    # Parse database URL
-    parsed_url = urlparse(database_url)
-    conn = pg8000.connect(
-        user=parsed_url.username,
-        password=parsed_url.password,
-        host=parsed_url.hostname,
-        port=parsed_url.port or 5432,
-        database=parsed_url.path.lstrip("/")
-    )
-    cursor = conn.cursor()
+READ_CHUNK_SIZE = 1 << 16
+
 
-    for json_file in json_files:
-        # Extract user_id from filename (filename without extension)
-        user_id = json_file.split("/")[-1].split(".")[0]
+def iter_json_array(f):
+    """
+    Yield the elements of a top-level JSON array one at a time without loading the whole file.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+    while True:
+        # Skip whitespace, the opening bracket and separators
+        while position < len(buffer) and (buffer[position] in " \t\r\n," or buffer[position] == "[" and not started):
+            if buffer[position] == "[":
+                started = True
+            position += 1
+        if position < len(buffer) and buffer[position] == "]" and started:
+            return
+        if position < len(buffer):
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A number at the very end of the buffer may still be incomplete
+                if end < len(buffer) or eof:
+                    yield element
+                    position = end
+                    continue
+        if eof:
+            if started:
+                raise ValueError("Unterminated JSON array")
+            return
+        # Read at least as much as is pending: an element spanning many chunks is then decoded
+        # a logarithmic number of times instead of once per chunk
+        chunk = f.read(max(READ_CHUNK_SIZE, len(buffer) - position))
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
 
-        # Load JSON data
-        with open(json_file, "r", encoding="utf-8") as f:
-            decks = json.load(f)
 
-        for deck in decks:
-            # Insert into decks table
-            deck_id = generate_uuid4();
-            cursor.execute(
-                "INSERT INTO decks (id, name, user_id) VALUES (%s, %s, %s)",
-                (deck_id, deck["name"], user_id)
-            )
+def open_deck_file(path):
+    # Compressed files are what the bot's /export command sends
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def flush_cards(cursor, rows):
+    if not rows:
+        return
+    # A statement may not update the same row twice: the last copy of a repeated id wins
+    columns = list(zip(*{row[0]: row for row in rows}.values()))
+    cursor.execute(
+        """
+        INSERT INTO cards (id, deck_id, user_id, front, back, last_revised, level, ease, interval_days, due_at)
+        SELECT * FROM unnest(
+            CAST(%s AS UUID[]), CAST(%s AS UUID[]), CAST(%s AS TEXT[]), CAST(%s AS TEXT[]),
+            CAST(%s AS TEXT[]), CAST(%s AS TIMESTAMP[]), CAST(%s AS INTEGER[]),
+            CAST(%s AS REAL[]), CAST(%s AS REAL[]), CAST(%s AS TIMESTAMP[])
+        )
+        ON CONFLICT (id) DO UPDATE SET
+            front = EXCLUDED.front, back = EXCLUDED.back,
+            last_revised = EXCLUDED.last_revised, level = EXCLUDED.level,
+            ease = EXCLUDED.ease, interval_days = EXCLUDED.interval_days, due_at = EXCLUDED.due_at
+        WHERE cards.user_id = EXCLUDED.user_id AND cards.deck_id = EXCLUDED.deck_id
+        """,
+        [list(column) for column in columns]
+    )
+    rows.clear()
+
 
-            print("deck_saved")
+def import_file(database_url, path, batch_size):
+    """
+    Import one user file in a single transaction.
+    :return: (path, status, decks, cards) where status is "imported" or "skipped".
+    """
+    file_name = os.path.basename(path)
+    user_id = file_name.split(".")[0]
+    file_fingerprint = fingerprint(path)
+    connection = pg8000.connect(**connect_params(database_url))
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT fingerprint FROM import_files WHERE file_name = %s", (file_name,))
+        row = cursor.fetchone()
+        if row and row[0] == file_fingerprint:
+            connection.rollback()
+            return path, "skipped", 0, 0
 
-            for card in deck.get("cards", []):
-                # Insert into cards table
-                card_id = generate_uuid4();
+        deck_count = card_count = 0
+        rows = []
+        with open_deck_file(path) as f:
+            for deck in iter_json_array(f):
+                # An existing deck with the same name keeps its id, and the file's cards join it
                 cursor.execute(
                     """
-                    INSERT INTO cards (id, deck_id, user_id, front, back, last_revised, level)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    INSERT INTO decks (id, name, user_id) VALUES (%s, %s, %s)
+                    ON CONFLICT (user_id, name) DO UPDATE SET name = EXCLUDED.name
+                    RETURNING id
                     """,
-                    (
-                        card_id,
+                    (deck.get("id") or str(uuid.uuid4()), deck["name"], user_id)
+                )
+                deck_id = str(cursor.fetchone()[0])
+                deck_count += 1
+                for card in deck.get("cards", []):
+                    rows.append((
+                        card.get("id") or str(uuid.uuid4()),
                         deck_id,
                         user_id,
                         card["front"],
                         card["back"],
                         card["last_revised"],
                         card["level"],
-                    )
-                )
-                print("card_saved")
+                        # Files written before scheduling existed have no scheduling state
+                        card.get("ease", 2.5),
+                        card.get("interval", 0.0),
+                        card.get("due_at") or card["last_revised"],
+                    ))
+                    card_count += 1
+                    if len(rows) >= batch_size:
+                        flush_cards(cursor, rows)
+        flush_cards(cursor, rows)
+
+        cursor.execute(
+            """
+            INSERT INTO import_files (file_name, fingerprint, decks, cards) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (file_name) DO UPDATE SET
+                fingerprint = EXCLUDED.fingerprint, decks = EXCLUDED.decks,
+                cards = EXCLUDED.cards, imported_at = now()
+            """,
+            (file_name, file_fingerprint, deck_count, card_count)
+        )
+        connection.commit()
+        return path, "imported", deck_count, card_count
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
 
-    # Commit changes and close connection
-    conn.commit()
-    cursor.close()
-    conn.close()
+def insert_data_from_json_files(database_url, json_files, workers=4, batch_size=1000, truncate=False):
+    pool = ConnectionPool(database_url, min_size=0, max_size=1)
+    try:
+        migrate(pool)
+    finally:
+        pool.close()
+    if truncate:
+        truncate_db(database_url)
+
+    started = time.perf_counter()
+    done = failed = skipped = total_decks = total_cards = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(import_file, database_url, path, batch_size): path for path in json_files}
+        for future in as_completed(futures):
+            done += 1
+            elapsed = time.perf_counter() - started
+            try:
+                path, status, decks, cards = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(json_files)}] {futures[future]}: FAILED {e}")
+                continue
+            skipped += status == "skipped"
+            total_decks += decks
+            total_cards += cards
+            print(f"[{done}/{len(json_files)}] {path}: {status}, {decks} decks, {cards} cards "
+                  f"({done / elapsed:.1f} files/s, {total_cards / elapsed:.0f} cards/s)")
+
+    elapsed = time.perf_counter() - started
+    print(f"Done in {elapsed:.1f}s: {done - failed - skipped} imported, {skipped} skipped, {failed} failed, "
+          f"{total_decks} decks, {total_cards} cards")
+    return failed == 0
 
 
 def truncate_db(database_url):
-    parsed_url = urlparse(database_url)
-    conn = pg8000.connect(
-        user=parsed_url.username,
-        password=parsed_url.password,
-        host=parsed_url.hostname,
-        port=parsed_url.port or 5432,
-        database=parsed_url.path.lstrip("/")
-    )
-    cursor = conn.cursor()
-    cursor.execute(
-        "DELETE FROM decks",
-    )
-    cursor.execute(
-        "DELETE FROM cards",
-    )
+    connection = pg8000.connect(**connect_params(database_url))
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM cards")
+    cursor.execute("DELETE FROM decks")
+    cursor.execute("DELETE FROM import_files")
+    connection.commit()
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("patterns", nargs="+", help="JSON files or glob patterns")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="Defaults to DATABASE_URL")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Files imported in parallel")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Cards per INSERT statement")
+    parser.add_argument("--truncate", action="store_true", help="Delete all decks and cards first")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("--database-url or DATABASE_URL is required")
+
+    json_files = sorted({path for pattern in args.patterns for path in glob.glob(pattern)})
+    if not insert_data_from_json_files(args.database_url, json_files, args.workers, args.batch_size, args.truncate):
+        raise SystemExit(1)
 
-# Example usage
-database_url = "db_url"
 
-json_files = glob.glob("[id].json")
-insert_data_from_json_files(database_url, json_files)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from telegram.ext import BaseUpdateProcessor
+from api_calls import current_user
+import functools
+import metrics
+import asyncio
+
+
+def update_owner(update):
+    """
+    The key whose updates must stay ordered: the user, or the chat for user-less updates.
+    """
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+def lock_owner(update):
+    """
+    The owner whose lock an update runs under, or None: inline queries never touch a session,
+    so they are answered while the user's chat updates wait for each other.
+    """
+    if not hasattr(update, "effective_user") or update.inline_query:
+        return None
+    return update_owner(update)
+
+
+class UserLocks:
+    def __init__(self):
+        """
+        One FIFO asyncio.Lock per user, created on demand and dropped as soon as no update holds or
+        waits for it, so idle users cost nothing. Re-entrant within a task: a handler wrapped with
+        serialized() runs directly when PerUserUpdateProcessor already holds its user's lock.
+        """
+        self._locks = {}  # owner -> [asyncio.Lock, number of updates holding or waiting for it]
+        self._held = ContextVar("held_user_lock", default=None)
+
+    @asynccontextmanager
+    async def hold(self, owner):
+        if owner is None or self._held.get() == owner:
+            yield
+            return
+        entry = self._locks.setdefault(owner, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                token = self._held.set(owner)
+                try:
+                    yield
+                finally:
+                    self._held.reset(token)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[owner]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+# Shared by the update processor and the handler wrappers
+user_locks = UserLocks()
+
+
+def serialized(callback, locks=None):
+    """
+    Wrap a handler callback so it runs under its update's user lock.
+    """
+    locks = locks or user_locks
+
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args, **kwargs):
+        async with locks.hold(lock_owner(update)):
+            return await callback(update, context, *args, **kwargs)
+    return wrapper
+
+
+def serialize_handlers(app, locks=None):
+    """
+    Wrap the callback of every handler registered on app with serialized(), so no two updates of
+    a user touch its sessions at once whatever update processor the application uses.
+    """
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = serialized(handler.callback, locks)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates, locks=None):
+        """
+        Process up to max_concurrent_updates updates at once while running each user's
+        updates one at a time in arrival order, so a session is never touched by two handlers.
+        """
+        super().__init__(max_concurrent_updates)
+        self.locks = locks or user_locks
+
+    async def process_update(self, update, coroutine):
+        # Queue on the user's lock before taking one of the shared slots, so a burst from one
+        # user waits without holding the slots every other user needs
+        async with self.locks.hold(lock_owner(update)):
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        if metrics.ENABLED:
+            coroutine = metrics.observe_update(update, coroutine)
+        owner = update_owner(update) if hasattr(update, "effective_user") else None
+        if owner is None:
+            await coroutine
+            return
+        # Tags this update's Bot API calls; reset after, as with a single slot the application
+        # runs every update in the same task
+        token = current_user.set(owner)
+        try:
+            await coroutine
+        finally:
+            current_user.reset(token)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
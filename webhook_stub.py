@@ -0,0 +1,155 @@
+"""
+Local stand-in for the Telegram Bot API to exercise webhook mode without Telegram.
+
+It answers the bot's API calls on --port and, once the bot has registered its webhook,
+posts synthetic updates from --users users to --webhook and reports latency.
+
+    python webhook_stub.py --port 8081 --webhook http://127.0.0.1:8443/telegram --secret s3cret
+    BOT_MODE=webhook BOT_API_BASE_URL=http://127.0.0.1:8081/bot WEBHOOK_PORT=8443 \\
+        WEBHOOK_PATH=telegram WEBHOOK_SECRET=s3cret WEBHOOK_URL=http://127.0.0.1:8443/telegram \\
+        CONCURRENT_UPDATES=32 BOT_TOKEN=1:stub python bot.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+import urllib.request
+import argparse
+import asyncio
+import itertools
+import json
+import statistics
+import time
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Flashcards", "username": "flashcards_stub_bot"}
+
+
+class StubBotApi:
+    def __init__(self):
+        self.calls = {}
+        self.webhook_set = asyncio.Event()
+        self._message_ids = itertools.count(1)
+
+    def _message(self, params):
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": params.get("message_id") or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", "")
+        }
+
+    def respond(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self.webhook_set.set()
+            return True
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            return self._message(params)
+        return True
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            _, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", "0")))
+
+            params = {}
+            if headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+                for name, values in parse_qs(body.decode("utf-8")).items():
+                    try:
+                        params[name] = json.loads(values[0])
+                    except ValueError:
+                        params[name] = values[0]
+            method = path.rstrip("/").rsplit("/", 1)[-1]
+            payload = json.dumps({"ok": True, "result": self.respond(method, params)}).encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                + f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def build_updates(users, updates_per_user):
+    update_ids = itertools.count(1)
+    texts = ["/menu", "/help", "/start"]
+    for step in range(updates_per_user):
+        for user in range(users):
+            user_id = 100000 + user
+            yield {
+                "update_id": next(update_ids),
+                "message": {
+                    "message_id": step + 1,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": f"user{user}"},
+                    "text": texts[step % len(texts)],
+                    "entities": [{"type": "bot_command", "offset": 0, "length": len(texts[step % len(texts)])}]
+                }
+            }
+
+
+def post_update(webhook, secret, update):
+    request = urllib.request.Request(
+        webhook,
+        data=json.dumps(update).encode("utf-8"),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret or ""}
+    )
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+async def run(args):
+    api = StubBotApi()
+    server = await asyncio.start_server(api.handle, "127.0.0.1", args.port)
+    print(f"Stub Bot API listening on 127.0.0.1:{args.port}, waiting for setWebhook...")
+    async with server:
+        await api.webhook_set.wait()
+        updates = list(build_updates(args.users, args.updates))
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            latencies = await asyncio.gather(*[
+                loop.run_in_executor(executor, post_update, args.webhook, args.secret, update)
+                for update in updates
+            ])
+        elapsed = time.perf_counter() - started
+        # Let the bot finish the replies it queued after acknowledging the last updates
+        await asyncio.sleep(args.settle)
+
+    latencies.sort()
+    print(f"Posted {len(updates)} updates from {args.users} users in {elapsed:.2f}s ({len(updates) / elapsed:.1f} updates/s)")
+    print(f"Webhook latency p50={statistics.median(latencies) * 1000:.1f}ms "
+          f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms max={latencies[-1] * 1000:.1f}ms")
+    print("Bot API calls: " + ", ".join(f"{method}={count}" for method, count in sorted(api.calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081, help="Port for the stub Bot API")
+    parser.add_argument("--webhook", default="http://127.0.0.1:8443/telegram", help="The bot's webhook URL")
+    parser.add_argument("--secret", default=None, help="Value for X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=5, help="Updates per user")
+    parser.add_argument("--concurrency", type=int, default=16, help="Parallel webhook posts")
+    parser.add_argument("--settle", type=float, default=2.0, help="Seconds to keep answering API calls afterwards")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()